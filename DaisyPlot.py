@@ -0,0 +1,41 @@
+"""
+Plots of daisyworld runs
+
+Kept apart from EvoDaisy so that the simulation, and every worker process
+running it, only imports NumPy. EvoDaisy imports this module when display
+is requested.
+"""
+import matplotlib.pyplot as plt
+
+from EvoDaisy import KELVIN_OFFSET
+
+
+def plot_run(area_hist, fluxes, Tp_vec, Tp_dead_vec, path="daisyworld.png"):
+    """
+    Save the species coverage and the planetary temperature of a run
+    ARGS:
+    area_hist: ndarray - (num_fluxes, diversity) species areas after each flux step
+    fluxes: ndarray - flux of each step
+    Tp_vec, Tp_dead_vec: ndarray - planetary and dead planet temperature (K) of each step
+    path: str - image file to write
+    """
+    fig, ax = plt.subplots(2, 1)
+    for i in range(area_hist.shape[1]):
+        ax[0].plot(list(range(len(fluxes))), 100 * area_hist[:, i], label=i)
+    ax[0].set_xlabel("Time")
+    ax[0].set_ylabel("Coverage Area (%)")
+
+    ax[1].plot(fluxes, Tp_vec - KELVIN_OFFSET, color="red")
+    ax[1].plot(fluxes, Tp_dead_vec - KELVIN_OFFSET, color="gray")
+    ax[1].set_xlabel("Time")
+    ax[1].set_ylabel("Global Temperature (C)")
+    plt.savefig(path)
+    plt.close(fig)
+
+
+def plot_trajectory(trajectory, path="daisyworld.png"):
+    """
+    Save the plots of plot_run for the records of one genome written by
+    TrajectoryRecorder
+    """
+    plot_run(trajectory["area"], trajectory["flux"], trajectory["Tp"], trajectory["Tp_dead"], path)
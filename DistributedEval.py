@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Distributed fitness evaluation for EvolSearch over TCP
+
+A Coordinator listens on a TCP address and hands out batches of genomes to
+any number of worker processes, on this or other machines, started with
+
+    python DistributedEval.py HOST:PORT --authkey KEY
+
+Workers receive the fitness function once (again after it changes, e.g. on
+load_checkpoint), evaluate each batch they are sent and stream the fitness
+values back. While a batch is being evaluated the worker sends a heartbeat
+every HEARTBEAT_INTERVAL seconds. A batch whose worker disconnects or stays
+silent for heartbeat_timeout seconds is put back in the queue and handed to
+another worker. Messages are pickled with dill, connections are
+authenticated with the shared authkey.
+"""
+import argparse
+import queue
+import threading
+import time
+
+import numpy as np
+from multiprocess import Process
+from multiprocess.connection import Client, Listener
+
+import PackedGenome
+
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+# batches per connected worker in each evaluate call
+BATCHES_PER_WORKER = 4
+
+
+def _heartbeat(send, done, interval):
+    """
+    send heartbeats until done is set
+    """
+    while not done.wait(interval):
+        send(("heartbeat",))
+
+
+def run_worker(address, authkey, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """
+    Connect to the coordinator at address and evaluate batches until it
+    sends stop or goes away
+    """
+    conn = Client(tuple(address), authkey=authkey)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    fitness_function = None
+    shared_arg = None
+    discrete_genotype_size = None
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+
+            if message[0] == "setup":
+                _, fitness_function, shared_arg, discrete_genotype_size = message
+            elif message[0] == "batch":
+                _, batch_id, discrete_rows, continuous_rows, row_args, threshold = message
+                keywords = {"threshold": threshold} if threshold is not None else {}
+                done = threading.Event()
+                beat = threading.Thread(target=_heartbeat, args=(send, done, heartbeat_interval), daemon=True)
+                beat.start()
+                try:
+                    if discrete_genotype_size is not None:
+                        discrete_rows = PackedGenome.unpack(discrete_rows, discrete_genotype_size)
+                    values = []
+                    aborted = []
+                    for i in range(len(continuous_rows)):
+                        args = [discrete_rows[i], continuous_rows[i]]
+                        if row_args is not None:
+                            args.append(row_args[i])
+                        elif shared_arg is not None:
+                            args.append(shared_arg[0])
+                        value = fitness_function(*args, **keywords)
+                        if threshold is not None:
+                            value, flag = value
+                            aborted.append(bool(flag))
+                        else:
+                            aborted.append(False)
+                        values.append(value)
+                    reply = ("result", batch_id, (values, aborted))
+                except Exception as e:
+                    reply = ("error", batch_id, repr(e))
+                finally:
+                    done.set()
+                    beat.join()
+                send(reply)
+            elif message[0] == "stop":
+                break
+    finally:
+        conn.close()
+
+
+def start_local_workers(address, authkey, num_workers, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """
+    start num_workers worker processes on this machine, returns the processes
+    """
+    workers = []
+    for _ in range(num_workers):
+        worker = Process(target=run_worker, args=(address, authkey, heartbeat_interval), daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+class Coordinator:
+    def __init__(self, address=("localhost", 0), authkey=None, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        """
+        Listen for workers
+        ARGS:
+        address: (host, port) - address to listen on, port 0 picks a free port, see self.address
+        authkey: bytes - shared secret workers must present
+        heartbeat_timeout: float - seconds of silence after which a worker's batch is reassigned
+        """
+        if not authkey:
+            raise Exception("Distributed evaluation needs an authkey")
+        self.listener = Listener(tuple(address), authkey=authkey)
+        self.address = self.listener.address
+        self.heartbeat_timeout = heartbeat_timeout
+
+        # (batch_id, payload) tasks, None tells a worker to stop
+        self.tasks = queue.Queue()
+        self.condition = threading.Condition()
+        self.results = {}
+        self.errors = []
+        self.next_batch_id = 0
+        self.num_workers = 0
+        self.num_reassigned = 0
+
+        self.setup = (None, None, None)
+        self.optional_args = None
+        self.setup_version = 0
+        self.closed = False
+
+        self.accept_thread = threading.Thread(target=self._accept, daemon=True)
+        self.accept_thread.start()
+
+    def set_function(self, fitness_function, optional_args=None, discrete_genotype_size=None):
+        """
+        set the fitness function sent to workers. optional_args are the
+        fitness_args of EvolSearch and discrete_genotype_size is set when the
+        discrete population is bit-packed
+        """
+        if optional_args is not None and len(optional_args) == 1:
+            shared_arg = list(optional_args)
+        else:
+            shared_arg = None
+        with self.condition:
+            self.setup = (fitness_function, shared_arg, discrete_genotype_size)
+            self.optional_args = optional_args
+            self.setup_version += 1
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                # closed listener or a client that failed authentication
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        """
+        feed batches to one worker connection
+        """
+        with self.condition:
+            self.num_workers += 1
+        version = None
+        task = None
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    conn.send(("stop",))
+                    return
+
+                if version != self.setup_version:
+                    with self.condition:
+                        setup = self.setup
+                        version = self.setup_version
+                    conn.send(("setup",) + setup)
+                batch_id, payload = task
+                conn.send(("batch", batch_id) + payload)
+
+                while True:
+                    if not conn.poll(self.heartbeat_timeout):
+                        raise TimeoutError("worker missed its heartbeats")
+                    message = conn.recv()
+                    if message[0] != "heartbeat":
+                        break
+
+                with self.condition:
+                    if message[0] == "error":
+                        self.errors.append(message[2])
+                        self.results[batch_id] = None
+                    else:
+                        self.results[batch_id] = message[2]
+                    self.condition.notify_all()
+                task = None
+        except (OSError, EOFError, TimeoutError):
+            # lost worker, hand its batch to another one
+            if task is not None:
+                with self.condition:
+                    self.num_reassigned += 1
+                self.tasks.put(task)
+        finally:
+            conn.close()
+            with self.condition:
+                self.num_workers -= 1
+
+    def evaluate(self, discrete_pop, continuous_pop, indices, timing=None, threshold=None):
+        """
+        returns the fitness of the individuals at indices and which of them
+        were aborted, blocks until every batch has been evaluated by some
+        worker. If timing is a dict the dispatch and gather times are added
+        to it. A threshold is passed on to the fitness function, see
+        EvolSearch abort_hopeless.
+        """
+        start = time.perf_counter()
+        num_batches = min(len(indices), BATCHES_PER_WORKER * max(self.num_workers, 1))
+        batch_ids = []
+        for chunk in np.array_split(indices, num_batches):
+            row_args = None
+            if self.optional_args is not None and len(self.optional_args) != 1:
+                row_args = [self.optional_args[i] for i in chunk]
+            with self.condition:
+                batch_id = self.next_batch_id
+                self.next_batch_id += 1
+            batch_ids.append(batch_id)
+            self.tasks.put((batch_id, (discrete_pop[chunk], continuous_pop[chunk], row_args, threshold)))
+        dispatched = time.perf_counter()
+
+        with self.condition:
+            self.condition.wait_for(lambda: all(b in self.results for b in batch_ids))
+            values = [self.results.pop(b) for b in batch_ids]
+            errors = self.errors
+            self.errors = []
+        if errors:
+            raise Exception("Fitness evaluation failed on a worker: " + errors[0])
+
+        if timing is not None:
+            timing["dispatch"] += dispatched - start
+            timing["gather"] += time.perf_counter() - dispatched
+        fitness = np.asarray([v for batch in values for v in batch[0]], dtype=float)
+        aborted = np.asarray([a for batch in values for a in batch[1]], dtype=bool)
+        return fitness, aborted
+
+    def close(self):
+        """
+        stop the connected workers and the listener
+        """
+        if self.closed:
+            return
+        self.closed = True
+        with self.condition:
+            num_workers = self.num_workers
+        for _ in range(num_workers):
+            self.tasks.put(None)
+        self.listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate EvolSearch batches for a Coordinator")
+    parser.add_argument("address", help="HOST:PORT of the coordinator")
+    parser.add_argument("--authkey", required=True, help="shared secret of the coordinator")
+    parser.add_argument("--processes", type=int, default=1, help="number of worker processes to start")
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL, help="seconds between heartbeats")
+    args = parser.parse_args()
+
+    host, port = args.address.rsplit(":", 1)
+    workers = start_local_workers((host, int(port)), args.authkey.encode(), args.processes, args.heartbeat)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,18 +12,53 @@ Evolutionary version of the Daisyworld model described in:
 by Eden Forbes
 """
 
-# Imports
+# Imports. Only NumPy is loaded with the module, plotting (DaisyPlot) and
+# Numba are imported when first needed so worker processes start quickly.
+import warnings
+from functools import partial
 import numpy as np
-import matplotlib.pyplot as plt
-import statistics
 
 # food web and albedos come from an evolutionary algorithm
 # and are discrete and continuous genotypes, respectively.
-def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, pert_value, perturbation):
-    """Run the daisyworld model"""
+def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, pert_value=None, perturbation=None, backend="python", stats=None, threshold=None):
+    """
+    Run the daisyworld model
+
+    backend selects the implementation of the relaxation loop:
+        "python" - the reference Species loop below
+        "numpy" - daisyworld_fitness_vectorized
+        "jit" - daisyworld_fitness_jit, compiled with Numba when it is installed
+
+    If stats is a dict it is filled with the total relaxation iterations
+    ("iterations"), the number of flux points simulated ("flux_points") and
+    whether every flux step reached max|darea| <= tol ("converged").
+
+    fluxes is either the flux schedule, perturbed by perturbation at the
+    flux steps listed in pert_value, or a ForcingSchedule built once with
+    the same arguments, in which case pert_value and perturbation are left
+    out. A forcing with K scenarios runs the genome against all of them with
+    daisyworld_fitness_ensemble and returns the mean duration.
+
+    If threshold is given the sweep is aborted as soon as the duration
+    provably cannot reach it (see _duration_bounds) and (duration, aborted)
+    is returned, where an aborted duration is a lower bound of the real one,
+    below threshold. Ensembles are never aborted.
+    """
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    if forcing.num_scenarios > 1:
+        duration = daisyworld_fitness_ensemble(food_web, albedos, diversity, maxconv, forcing, stats=stats)
+        if threshold is not None:
+            return duration, False
+        return duration
+    if backend == "numpy":
+        return daisyworld_fitness_vectorized(food_web, albedos, diversity, maxconv, display, forcing, stats=stats, threshold=threshold)
+    elif backend == "jit":
+        return daisyworld_fitness_jit(food_web, albedos, diversity, maxconv, display, forcing, stats=stats, threshold=threshold)
+    elif backend != "python":
+        raise Exception("Unknown daisyworld_fitness backend: " + str(backend))
 
     class world:
-        def __init__(self, food_web, diversity, fluxes):
+        def __init__(self, food_web, diversity, forcing):
             # Convergence Criteria
             self.diversity = diversity
             self.alb_low = 0.1
@@ -35,16 +70,17 @@ def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, p
             self.Sflux_min = 0.5
             self.Sflux_max = 2.0
             self.Sflux_step = 0.002
-            self.fluxes = fluxes
+            self.fluxes = forcing.base_fluxes[0]
+            self.forcing = forcing
             self.insul = 20
             self.spec_list = []
-            self.web = np.reshape(food_web, (diversity, diversity))
+            # copy so that zeroing the diagonal never touches the caller's genome,
+            # which is a row of the population when evaluated in this process
+            self.web = np.array(np.reshape(food_web, (diversity, diversity)))
             np.fill_diagonal(self.web, 0)
             self.init_life = 0
             self.end_life = 0
             self.duration = 0
-            self.pert_value = pert_value
-            self.perturbation = perturbation
 
     class Species:
         def __init__(self, world, troph, alb):
@@ -72,7 +108,7 @@ def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, p
 
     # Initialize arrays
 
-    daisyworld = world(food_web, diversity, fluxes)
+    daisyworld = world(food_web, diversity, forcing)
 
     counter_troph = 0
     for i in daisyworld.web[0]:
@@ -86,11 +122,22 @@ def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, p
     Tp_vec = np.zeros_like(daisyworld.fluxes)
     Tp_dead_vec = np.zeros_like(daisyworld.fluxes)
 
+    if stats is not None:
+        stats["iterations"] = 0
+        stats["flux_points"] = 0
+        stats["converged"] = True
+
+    aborted = False
+    if threshold is not None:
+        bounds = _duration_bounds(daisyworld.forcing.fluxes, daisyworld.forcing.end_fluxes)
+
     # Loop over fluxes
-    for j, flux in enumerate(daisyworld.fluxes):
+    for j in range(len(daisyworld.fluxes)):
 
-        if j in daisyworld.pert_value:
-            flux = flux + daisyworld.perturbation
+        # perturbed flux, flux * So / sigma and dead planet temperature
+        flux = daisyworld.forcing.fluxes[0, j]
+        flux_factor = daisyworld.forcing.flux_factor[0, j]
+        Tp_dead = daisyworld.forcing.Tp_dead[0, j]
 
         # Minimum species coverage
         area_covered = 0
@@ -120,8 +167,7 @@ def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, p
             # print(alb_p)
 
             # Planetary temperature
-            Tp = np.power(flux * So * (1 - alb_p) / sigma, 0.25)
-            Tp_dead = np.power(flux * So * (1 - daisyworld.alb_barren) / sigma, 0.25)
+            Tp = np.power(flux_factor * (1 - alb_p), 0.25)
 
             # Local temperatures
             for s in daisyworld.spec_list:
@@ -178,6 +224,12 @@ def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, p
             area_barren = 1 - area_counter_2
             it += 1
 
+        if stats is not None:
+            stats["iterations"] += it
+            stats["flux_points"] += 1
+            if max(abs(s.darea) for s in daisyworld.spec_list) > daisyworld.tol:
+                stats["converged"] = False
+
         # Save states
         area_counter_3 = 0
         for s in daisyworld.spec_list:
@@ -202,33 +254,993 @@ def daisyworld_fitness(food_web, albedos, diversity, maxconv, display, fluxes, p
                 daisyworld.end_life = flux
         if daisyworld.end_life != 0:
             break
-        
+
+        # Give up once the duration cannot reach threshold
+        if threshold is not None and j < len(daisyworld.fluxes) - 1:
+            upper, lower = _bound_at(bounds, j, daisyworld.init_life)
+            if upper < threshold:
+                aborted = True
+                break
+
+    if aborted:
+        return lower, True
+
     if daisyworld.end_life == 0:
-        daisyworld.end_life = daisyworld.fluxes[-1]
+        daisyworld.end_life = daisyworld.forcing.end_fluxes[0]
 
         ### GRAPHS ###
     if display == True:
-        fig, ax = plt.subplots(2, 1)
-
-        for s in daisyworld.spec_list:
-            ax[0].plot(list(range(len(daisyworld.fluxes))), 100 * s.area_vec, label=s.troph)
-       # ax[0].plot(list(range(len(daisyworld.fluxes))), 100 * area_vec, color="black", label="total")
-       # ax[0].plot(
-       #     list(range(len(daisyworld.fluxes))), 100 * area_barren_vec, color="brown", label="total"
-       # )
-
-        ax[0].set_xlabel("Time")
-        ax[0].set_ylabel("Coverage Area (%)")
+        from DaisyPlot import plot_run
 
-        ax[1].plot(daisyworld.fluxes, Tp_vec - KELVIN_OFFSET, color="red")
-        ax[1].plot(daisyworld.fluxes, Tp_dead_vec - KELVIN_OFFSET, color="gray")
-        ax[1].set_xlabel("Time")
-        ax[1].set_ylabel("Global Temperature (C)")
-        plt.savefig("daisyworld.png")
+        area_hist = np.stack([s.area_vec for s in daisyworld.spec_list], axis=1)
+        plot_run(area_hist, daisyworld.fluxes, Tp_vec, Tp_dead_vec)
 
     daisyworld.duration = daisyworld.end_life - daisyworld.init_life
     
     ## CHOOSE FITNESS FUNCTION
+    if threshold is not None:
+        return daisyworld.duration, False
     return daisyworld.duration
     # return daisyworld.duration
 
+
+
+# Model constants shared by the array based engines below. These mirror the
+# values set up inside daisyworld_fitness.
+KELVIN_OFFSET = 273.15
+TD_MIN = 5 + KELVIN_OFFSET
+TD_MAX = 40 + KELVIN_OFFSET
+TD_IDEAL = 22.5 + KELVIN_OFFSET
+SO = 1000
+SIGMA = 5.67032e-8
+ALB_BARREN = 0.4
+INSUL = 20
+TOL = 0.000001
+MIN_AREA = 0.01
+DRATE = 0.3
+
+# Relaxation solvers. "fixed" is the 1/50 under-relaxation of
+# daisyworld_fitness. "newton" takes implicit Euler steps using the analytic
+# Jacobian of darea, growing the step as the residual max|darea| falls
+# (pseudo-transient continuation) so that it turns into Newton's method near
+# the steady state, and stops once the residual is below TOL.
+SOLVERS = ("fixed", "newton")
+FIXED_STEP = 1 / 50
+NEWTON_INITIAL_STEP = 1.0
+NEWTON_MAX_STEP = 1e8
+
+# Food web interaction terms. Dense webs use matrix products, sparse webs sum
+# over the nonzero links only. With sparse=None the engines pick sparse when
+# diversity is at least SPARSE_MIN_DIVERSITY and at most SPARSE_DENSITY of the
+# web entries are links.
+SPARSE_MIN_DIVERSITY = 100
+SPARSE_DENSITY = 0.05
+
+
+def _use_sparse(webs, sparse):
+    """
+    returns True if the food webs, shape (..., diversity, diversity), should
+    use the sparse interaction terms
+    """
+    if sparse is not None:
+        return bool(sparse)
+    return webs.shape[-1] >= SPARSE_MIN_DIVERSITY and np.count_nonzero(webs == 1) <= SPARSE_DENSITY * webs.size
+
+
+def _sparse_interactions(area, species, partners):
+    """
+    predators - prey of every species from the nonzero links
+
+    area is flat and link n says that species[n] gains area[partners[n]]
+    (predators) and partners[n] loses area[species[n]] (prey), the same as
+    web @ area - web.T @ area for the dense web.
+    """
+    n = area.shape[0]
+    return np.bincount(species, area[partners], n) - np.bincount(partners, area[species], n)
+
+
+def _newton_increment(area, area_barren, alb, links, links_T, alb_p, Tp, Td, birth, growth, step):
+    """
+    Solve (I / step - J) dx = darea for a batch of individuals
+
+    All arguments carry a leading batch axis, area etc. are (n, diversity)
+    and alb_p, Tp and step are (n,). growth is darea / area and J is the
+    analytic Jacobian of darea = area * growth with respect to area.
+    """
+    n, diversity = area.shape
+    diag = np.arange(diversity)
+
+    # d Td_i / d area_k is the same for every i
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dTp = -0.25 * Tp / (1 - alb_p)
+    # below zero flux Tp is NaN and nothing is born, the temperature terms drop out
+    dTp = np.where(np.isfinite(dTp), dTp, 0.0)
+    dTd = (INSUL + dTp)[:, None] * (alb - ALB_BARREN)
+    live = (Td >= TD_MIN) & (Td <= TD_MAX) & (area >= 0.005)
+    dbirth = np.where(live, -2 * 0.003265 * (Td - TD_IDEAL), 0.0) * area_barren[:, None]
+
+    dgrowth = dbirth[:, :, None] * dTd[:, None, :] - birth[:, :, None] + links - links_T
+    jac = area[:, :, None] * dgrowth
+    jac[:, diag, diag] += growth
+
+    system = np.eye(diversity) / step[:, None, None] - jac
+    rhs = (area * growth)[:, :, None]
+    try:
+        return np.linalg.solve(system, rhs)[:, :, 0]
+    except np.linalg.LinAlgError:
+        return np.matmul(np.linalg.pinv(system), rhs)[:, :, 0]
+
+
+def daisyworld_trajectory(food_web, albedos, diversity, maxconv, fluxes, pert_value=None, perturbation=None, solver="fixed", sparse=None):
+    """
+    Run the daisyworld model of a single genome step by step
+
+    Takes the arguments of daisyworld_fitness_vectorized and yields a dict
+    after every flux step, as the sweep goes:
+        step - index of the flux step
+        flux - the perturbed flux
+        area - copy of the species areas
+        area_barren - barren area
+        Tp - planetary temperature, Tp_dead - dead planet temperature
+        iterations - relaxation iterations used at this step
+        converged - whether max|darea| <= TOL at the end of the step
+        init_life, end_life - flux at which life started and ended so far,
+                              0 if not yet. On the last state end_life
+                              falls back to the unperturbed last flux, so
+                              end_life - init_life is the fitness.
+    The sweep stops after the step at which life ends.
+    """
+    if solver not in SOLVERS:
+        raise Exception("Unknown solver: " + str(solver))
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    if forcing.num_scenarios != 1:
+        raise Exception("daisyworld_trajectory takes a single forcing scenario")
+    num_fluxes = forcing.num_fluxes
+
+    # copy so that zeroing the diagonal never touches the caller's genome
+    web = np.array(np.reshape(food_web, (diversity, diversity)))
+    np.fill_diagonal(web, 0)
+    links = (web == 1).astype(float)
+    links_T = np.ascontiguousarray(links.T)
+    if _use_sparse(web, sparse):
+        species, partners = np.nonzero(links)
+    else:
+        species = None
+
+    # species albedos are picked from the continuous genome by row 0 of the web
+    alb = np.asarray(albedos, dtype=float)[web[0]]
+    area = np.full(diversity, MIN_AREA)
+
+    init_life = 0
+    end_life = 0
+    for j in range(num_fluxes):
+        flux = forcing.fluxes[0, j]
+        flux_factor = forcing.flux_factor[0, j]
+
+        # Minimum species coverage
+        np.maximum(area, MIN_AREA, out=area)
+        area_barren = 1 - area.sum()
+
+        # the loop version never refreshes min_dA, so in fixed mode every
+        # flux step runs exactly maxconv + 1 relaxation iterations
+        it = 0
+        step = NEWTON_INITIAL_STEP
+        last_residual = np.inf
+        while it <= maxconv:
+            alb_p = area @ alb + area_barren * ALB_BARREN
+            Tp = np.power(flux_factor * (1 - alb_p), 0.25)
+
+            Td = INSUL * (alb_p - alb) + Tp
+            birth = np.where(
+                (Td >= TD_MIN) & (Td <= TD_MAX) & (area >= 0.005),
+                1 - 0.003265 * (Td - TD_IDEAL) ** 2,
+                0.0,
+            )
+
+            if species is not None:
+                interactions = _sparse_interactions(area, species, partners)
+            else:
+                interactions = links @ area - links_T @ area
+            growth = birth * area_barren - DRATE + interactions
+            darea = area * growth
+            it += 1
+
+            if solver == "newton":
+                residual = np.abs(darea).max()
+                if residual <= TOL:
+                    break
+                if np.isfinite(last_residual):
+                    step = min(step * last_residual / residual, NEWTON_MAX_STEP)
+                last_residual = residual
+
+                dx = _newton_increment(
+                    area[None], np.array([area_barren]), alb[None], links[None], links_T[None],
+                    np.array([alb_p]), np.array([Tp]), Td[None], birth[None], growth[None],
+                    np.array([step]),
+                )[0]
+                np.maximum(area + dx, 0, out=area)
+            else:
+                area += FIXED_STEP * darea
+            area_barren = 1 - area.sum()
+
+        # Check life init, end
+        current_max = max(area.max(), 0)
+        if init_life == 0:
+            if current_max > MIN_AREA:
+                init_life = flux
+        if init_life != 0:
+            if current_max < MIN_AREA:
+                end_life = flux
+        if end_life == 0 and j == num_fluxes - 1:
+            end_life = forcing.end_fluxes[0]
+
+        yield {
+            "step": j,
+            "flux": flux,
+            "area": area.copy(),
+            "area_barren": area_barren,
+            "Tp": Tp,
+            "Tp_dead": forcing.Tp_dead[0, j],
+            "iterations": it,
+            "converged": bool(np.abs(darea).max() <= TOL),
+            "init_life": init_life,
+            "end_life": end_life,
+        }
+        if end_life != 0:
+            break
+
+
+def daisyworld_fitness_vectorized(food_web, albedos, diversity, maxconv, display, fluxes, pert_value=None, perturbation=None, solver="fixed", sparse=None, stats=None, threshold=None):
+    """
+    Run the daisyworld model with species state held as NumPy vectors
+
+    Same arguments and return value as daisyworld_fitness, for a single
+    forcing scenario. Area, albedo,
+    birth rate and darea are stored as arrays of length diversity and the
+    food web interaction terms are computed as web @ area (predators) and
+    web.T @ area (prey) instead of walking the web in Python. The sweep
+    itself is daisyworld_trajectory.
+
+    Only the summation order differs from the loop version, so species
+    areas agree with it to within 1e-9 and the returned duration is the same
+    unless an area lands within that tolerance of min_area at a flux step.
+
+    solver is "fixed" (the default, same as the loop version) or "newton",
+    see SOLVERS. sparse selects dense (False) or sparse (True) interaction
+    terms, by default it is picked from the web density. If stats is a dict it
+    is filled with the relaxation iterations used at each flux step
+    ("step_iterations"), their total
+    ("iterations"), the number of flux points simulated ("flux_points") and
+    whether every flux step reached max|darea| <= TOL ("converged"). threshold
+    is as in daisyworld_fitness.
+    """
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    if forcing.num_scenarios != 1:
+        raise Exception("daisyworld_fitness_vectorized takes a single forcing scenario, see daisyworld_fitness_ensemble")
+    fluxes = forcing.base_fluxes[0]
+    aborted = False
+    if threshold is not None:
+        bounds = _duration_bounds(forcing.fluxes, forcing.end_fluxes)
+
+    if display:
+        area_hist = np.zeros((len(fluxes), diversity))
+        Tp_vec = np.zeros(len(fluxes))
+        Tp_dead_vec = np.zeros(len(fluxes))
+
+    step_iterations = []
+    converged = True
+    for state in daisyworld_trajectory(food_web, albedos, diversity, maxconv, forcing, solver=solver, sparse=sparse):
+        step_iterations.append(state["iterations"])
+        converged = converged and state["converged"]
+        if display:
+            area_hist[state["step"]] = state["area"]
+            Tp_vec[state["step"]] = state["Tp"]
+            Tp_dead_vec[state["step"]] = state["Tp_dead"]
+
+        # Give up once the duration cannot reach threshold
+        if threshold is not None and state["end_life"] == 0:
+            upper, lower = _bound_at(bounds, state["step"], state["init_life"])
+            if upper < threshold:
+                aborted = True
+                break
+
+    if stats is not None:
+        stats["step_iterations"] = step_iterations
+        stats["iterations"] = sum(step_iterations)
+        stats["flux_points"] = len(step_iterations)
+        stats["converged"] = bool(converged)
+
+    if display:
+        from DaisyPlot import plot_run
+
+        plot_run(area_hist, fluxes, Tp_vec, Tp_dead_vec)
+
+    if threshold is not None:
+        if aborted:
+            return lower, True
+        return state["end_life"] - state["init_life"], False
+    return state["end_life"] - state["init_life"]
+
+
+def daisyworld_fitness_batch(discrete_pop, continuous_pop, diversity, maxconv, fluxes, pert_value=None, perturbation=None, solver="fixed", sparse=None, stats=None, threshold=None):
+    """
+    Run the daisyworld model for a whole population at once
+
+    discrete_pop and continuous_pop are the (pop_size, diversity**2) and
+    (pop_size, diversity) genotype matrices used by EvolSearch. All
+    individuals are advanced together as (pop_size, diversity) arrays.
+    Individuals whose life has ended are dropped from the batch at the end of
+    that flux step and individuals whose relaxation has converged are masked
+    out of the remaining iterations, so neither holds up the others.
+
+    solver, sparse and stats are as in daisyworld_fitness_vectorized, with
+    sparse picked from the density of all the webs together and the stats
+    entries "iterations", "flux_points" and "converged" given as arrays with
+    one value per individual.
+
+    Returns an array of durations, one per individual, equal to what
+    daisyworld_fitness_vectorized returns for each genome. With a threshold,
+    a number or one per individual, individuals are dropped from the batch
+    as soon as their duration cannot reach it and (durations, aborted) is
+    returned, aborted durations being lower bounds as in daisyworld_fitness.
+    """
+    pop_size = np.shape(discrete_pop)[0]
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    if forcing.num_scenarios != 1:
+        raise Exception("daisyworld_fitness_batch takes a single forcing scenario, see daisyworld_fitness_ensemble_batch")
+    durations, aborted = _sweep_batch(
+        discrete_pop, continuous_pop, diversity, maxconv,
+        np.broadcast_to(forcing.fluxes, (pop_size, forcing.num_fluxes)),
+        np.broadcast_to(forcing.flux_factor, (pop_size, forcing.num_fluxes)),
+        np.broadcast_to(forcing.end_fluxes, (pop_size,)),
+        solver, sparse, stats, threshold,
+    )
+    if threshold is not None:
+        return durations, aborted
+    return durations
+
+
+def _sweep_batch(discrete_pop, continuous_pop, diversity, maxconv, flux_schedules, flux_factors, end_fluxes, solver, sparse, stats, threshold=None):
+    """
+    Batched relaxation behind daisyworld_fitness_batch and the ensembles
+
+    Row i of the population is run against the already perturbed flux
+    schedule flux_schedules[i], with flux * SO / SIGMA in flux_factors[i],
+    and end_fluxes[i] is its end_life when life never ends. Rows that cannot
+    reach threshold are aborted. Returns the durations and which rows were
+    aborted, their durations being lower bounds.
+    """
+    if solver not in SOLVERS:
+        raise Exception("Unknown solver: " + str(solver))
+
+    pop_size = np.shape(discrete_pop)[0]
+    webs = np.array(np.reshape(discrete_pop, (pop_size, diversity, diversity)))
+    diag = np.arange(diversity)
+    webs[:, diag, diag] = 0
+    use_sparse = _use_sparse(webs, sparse)
+    if use_sparse:
+        # (individual, species, partner) of every link, dense links are only
+        # kept for the newton Jacobian
+        member, species, partners = np.nonzero(webs == 1)
+        flat_species = member * diversity + species
+        flat_partners = member * diversity + partners
+    if not use_sparse or solver == "newton":
+        links = (webs == 1).astype(float)
+        links_T = np.ascontiguousarray(links.transpose(0, 2, 1))
+    else:
+        links = None
+        links_T = None
+    alb = np.take_along_axis(np.asarray(continuous_pop, dtype=float), webs[:, 0], axis=1)
+    area = np.full((pop_size, diversity), MIN_AREA)
+
+    init_life = np.zeros(pop_size)
+    end_life = np.zeros(pop_size)
+    iterations = np.zeros(pop_size, dtype=int)
+    flux_points = np.zeros(pop_size, dtype=int)
+    converged = np.ones(pop_size, dtype=bool)
+    aborted = np.zeros(pop_size, dtype=bool)
+    lower_bounds = np.zeros(pop_size)
+    if threshold is not None:
+        thresholds = np.broadcast_to(np.asarray(threshold, dtype=float), (pop_size,))
+        started_upper, started_lower, unstarted_upper, unstarted_lower = _duration_bounds(flux_schedules, end_fluxes)
+
+    # individuals still in the flux sweep, the arrays above are compacted to these
+    alive = np.arange(pop_size)
+    for j in range(flux_schedules.shape[1]):
+        flux = flux_schedules[alive, j]
+        flux_factor = flux_factors[alive, j]
+
+        # Minimum species coverage
+        np.maximum(area, MIN_AREA, out=area)
+        area_barren = 1 - area.sum(axis=1)
+
+        # relax every alive individual, masking out those that have converged.
+        # In fixed mode no individual is checked for convergence, so as in the
+        # loop version all of them run exactly maxconv + 1 iterations.
+        step = np.full(len(alive), NEWTON_INITIAL_STEP)
+        last_residual = np.full(len(alive), np.inf)
+        step_converged = np.zeros(len(alive), dtype=bool)
+        relaxing = np.arange(len(alive))
+        it = 0
+        while len(relaxing) and it <= maxconv:
+            if len(relaxing) == len(alive):
+                rows = slice(None)
+            else:
+                rows = relaxing
+            a = area[rows]
+            ab = area_barren[rows]
+            al = alb[rows]
+
+            alb_p = np.einsum("pi,pi->p", a, al) + ab * ALB_BARREN
+            Tp = np.power(flux_factor[rows] * (1 - alb_p), 0.25)
+
+            Td = INSUL * (alb_p[:, None] - al) + Tp[:, None]
+            birth = np.where(
+                (Td >= TD_MIN) & (Td <= TD_MAX) & (a >= 0.005),
+                1 - 0.003265 * (Td - TD_IDEAL) ** 2,
+                0.0,
+            )
+
+            if use_sparse:
+                interactions = _sparse_interactions(area.reshape(-1), flat_species, flat_partners)
+                interactions = interactions.reshape(area.shape)[rows]
+            else:
+                predators = np.matmul(links[rows], a[:, :, None])[:, :, 0]
+                prey = np.matmul(links_T[rows], a[:, :, None])[:, :, 0]
+                interactions = predators - prey
+            growth = birth * ab[:, None] - DRATE + interactions
+            darea = a * growth
+            residual = np.abs(darea).max(axis=1)
+            iterations[alive[relaxing]] += 1
+            it += 1
+
+            if solver == "newton":
+                # drop converged individuals before stepping the others
+                done = residual <= TOL
+                step_converged[relaxing[done]] = True
+                keep = ~done
+                relaxing = relaxing[keep]
+                if len(relaxing) == 0:
+                    break
+
+                h = step[relaxing]
+                last = last_residual[relaxing]
+                h = np.where(np.isfinite(last), np.minimum(h * last / residual[keep], NEWTON_MAX_STEP), h)
+                step[relaxing] = h
+                last_residual[relaxing] = residual[keep]
+
+                dx = _newton_increment(
+                    a[keep], ab[keep], al[keep], links[relaxing], links_T[relaxing],
+                    alb_p[keep], Tp[keep], Td[keep], birth[keep], growth[keep], h,
+                )
+                a = np.maximum(a[keep] + dx, 0)
+                area[relaxing] = a
+                area_barren[relaxing] = 1 - a.sum(axis=1)
+            else:
+                step_converged[relaxing] = residual <= TOL
+                a = a + FIXED_STEP * darea
+                area[rows] = a
+                area_barren[rows] = 1 - a.sum(axis=1)
+
+        flux_points[alive] += 1
+        converged[alive[~step_converged]] = False
+
+        # Check life init, end
+        current_max = np.maximum(area.max(axis=1), 0)
+        ids = alive
+        starting = (init_life[ids] == 0) & (current_max > MIN_AREA)
+        init_life[ids[starting]] = flux[starting]
+        ending = (init_life[ids] != 0) & (current_max < MIN_AREA)
+        end_life[ids[ending]] = flux[ending]
+
+        # drop the individuals whose duration cannot reach threshold
+        leaving = ending
+        if threshold is not None and j < flux_schedules.shape[1] - 1:
+            started = init_life[ids] != 0
+            upper = np.where(started, started_upper[ids, j] - init_life[ids], unstarted_upper[ids, j])
+            hopeless = ~ending & (upper < thresholds[ids])
+            if np.any(hopeless):
+                lower = np.where(started, started_lower[ids, j] - init_life[ids], unstarted_lower[ids, j])
+                aborted[ids[hopeless]] = True
+                lower_bounds[ids[hopeless]] = lower[hopeless]
+                leaving = ending | hopeless
+
+        if np.any(leaving):
+            keep = ~leaving
+            alive = alive[keep]
+            area = area[keep]
+            alb = alb[keep]
+            if links is not None:
+                links = links[keep]
+                links_T = links_T[keep]
+            if use_sparse:
+                kept = keep[member]
+                member = (np.cumsum(keep) - 1)[member[kept]]
+                species = species[kept]
+                partners = partners[kept]
+                flat_species = member * diversity + species
+                flat_partners = member * diversity + partners
+            if len(alive) == 0:
+                break
+
+    unended = end_life == 0
+    end_life[unended] = end_fluxes[unended]
+
+    if stats is not None:
+        stats["iterations"] = iterations
+        stats["flux_points"] = flux_points
+        stats["converged"] = converged
+
+    durations = end_life - init_life
+    durations[aborted] = lower_bounds[aborted]
+    return durations, aborted
+
+
+def _duration_bounds(fluxes, end_fluxes):
+    """
+    Bounds on the duration a run can still reach after each flux step
+
+    fluxes are (rows, num_fluxes) perturbed schedules and end_fluxes the
+    end_life of each row when life never ends. After step j, a run whose life
+    started at init_life ends at a later flux or at end_fluxes, so its
+    duration lies between started_lower[:, j] - init_life and
+    started_upper[:, j] - init_life. A run whose life has not started either
+    starts at a later step and ends after it, or never starts and gets
+    end_fluxes, its duration lies between unstarted_lower[:, j] and
+    unstarted_upper[:, j]. Returns started_upper, started_lower,
+    unstarted_upper and unstarted_lower as (rows, num_fluxes) arrays.
+    """
+    fluxes = np.asarray(fluxes, dtype=float)
+    end = np.asarray(end_fluxes, dtype=float)[:, None]
+
+    def after(values, reduce, fill):
+        # reduce over values[:, j + 1:] for every j, fill after the last step
+        suffix = reduce.accumulate(values[:, ::-1], axis=1)[:, ::-1]
+        return np.concatenate((suffix[:, 1:], np.full((len(values), 1), fill)), axis=1)
+
+    started_upper = np.maximum(after(fluxes, np.maximum, -np.inf), end)
+    started_lower = np.minimum(after(fluxes, np.minimum, np.inf), end)
+    unstarted_upper = np.maximum(after(started_upper - fluxes, np.maximum, -np.inf), end)
+    unstarted_lower = np.minimum(after(started_lower - fluxes, np.minimum, np.inf), end)
+    return started_upper, started_lower, unstarted_upper, unstarted_lower
+
+
+def _bound_at(bounds, step, init_life):
+    """
+    returns the upper and lower duration bound of a single run after step,
+    from the (1, num_fluxes) _duration_bounds of its forcing
+    """
+    started_upper, started_lower, unstarted_upper, unstarted_lower = bounds
+    if init_life != 0:
+        return started_upper[0, step] - init_life, started_lower[0, step] - init_life
+    return unstarted_upper[0, step], unstarted_lower[0, step]
+
+
+# Ensemble fitness. Each genome is run against K forcing scenarios stacked
+# along a scenario axis of the batch engine and the K durations are reduced
+# to a single fitness.
+
+
+def forcing_scenarios(fluxes, pert_value, perturbation):
+    """
+    Build the perturbed flux schedule of each forcing scenario
+
+    fluxes is one schedule or a (K, num_fluxes) array of schedules,
+    pert_value a list of flux step indices or a list of K such lists and
+    perturbation a number or K numbers, None for no perturbation. Arguments
+    given once are shared by all scenarios. Returns the (K, num_fluxes) schedules with the
+    perturbation added at the pert_value steps and the K unperturbed last
+    fluxes, used as end_life when life never ends.
+    """
+    if pert_value is None or perturbation is None:
+        pert_value = []
+        perturbation = 0.0
+    fluxes = np.atleast_2d(np.asarray(fluxes, dtype=float))
+    perturbation = np.atleast_1d(np.asarray(perturbation, dtype=float))
+    if len(pert_value) and np.iterable(pert_value[0]):
+        pert_values = list(pert_value)
+    else:
+        pert_values = [pert_value]
+
+    num_scenarios = max(len(fluxes), len(perturbation), len(pert_values))
+    for name, count in (("fluxes", len(fluxes)), ("perturbation", len(perturbation)), ("pert_value", len(pert_values))):
+        if count not in (1, num_scenarios):
+            raise Exception("Number of %s scenarios (%d) does not match %d" % (name, count, num_scenarios))
+
+    num_fluxes = fluxes.shape[1]
+    schedules = np.array(np.broadcast_to(fluxes, (num_scenarios, num_fluxes)))
+    for k in range(num_scenarios):
+        steps = set(pert_values[k % len(pert_values)])
+        perturbed = [j for j in range(num_fluxes) if j in steps]
+        schedules[k, perturbed] += perturbation[k % len(perturbation)]
+
+    end_fluxes = np.array(np.broadcast_to(fluxes[:, -1], (num_scenarios,)))
+    return schedules, end_fluxes
+
+
+class ForcingSchedule:
+    # per scenario arrays, in the order of arrays() and from_arrays()
+    FIELDS = ("base_fluxes", "fluxes", "end_fluxes", "flux_factor", "Tp_dead")
+
+    def __init__(self, fluxes, pert_value=None, perturbation=None):
+        """
+        Forcing of a run, built once and shared read-only by every genome
+
+        Takes the fluxes, pert_value and perturbation arguments of the
+        simulators, including K scenarios as in forcing_scenarios, and holds
+        for each scenario and flux step
+            base_fluxes - the unperturbed fluxes
+            fluxes - the perturbed fluxes
+            flux_factor - flux * SO / SIGMA, so Tp = (flux_factor * (1 - alb_p)) ** 0.25
+            Tp_dead - the dead planet temperature (flux_factor * (1 - ALB_BARREN)) ** 0.25
+        as read-only (num_scenarios, num_fluxes) arrays, and end_fluxes,
+        the unperturbed last flux of each scenario.
+        """
+        perturbed, end_fluxes = forcing_scenarios(fluxes, pert_value, perturbation)
+        base_fluxes = np.broadcast_to(np.atleast_2d(np.asarray(fluxes, dtype=float)), perturbed.shape)
+        flux_factor = perturbed * SO / SIGMA
+        self._set(
+            base_fluxes=np.array(base_fluxes),
+            fluxes=perturbed,
+            end_fluxes=end_fluxes,
+            flux_factor=flux_factor,
+            Tp_dead=np.power(flux_factor * (1 - ALB_BARREN), 0.25),
+        )
+
+    def _set(self, **arrays):
+        for name in self.FIELDS:
+            array = arrays[name]
+            array.flags.writeable = False
+            setattr(self, name, array)
+
+    @property
+    def num_scenarios(self):
+        return self.fluxes.shape[0]
+
+    @property
+    def num_fluxes(self):
+        return self.fluxes.shape[1]
+
+    def arrays(self):
+        """
+        returns the arrays of the schedule by field name
+        """
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        rebuild a schedule from the arrays() of another one, without copying
+        them, e.g. from shared memory views or a checkpoint
+        """
+        forcing = cls.__new__(cls)
+        forcing._set(**{name: arrays[name] for name in cls.FIELDS})
+        return forcing
+
+    def subsample(self, stride):
+        """
+        returns a schedule keeping every stride-th flux step, a cheaper low
+        fidelity version of this one. end_fluxes are kept, so durations stay
+        in the same flux units.
+        """
+        arrays = {name: np.array(array[:, ::stride]) for name, array in self.arrays().items() if array.ndim == 2}
+        arrays["end_fluxes"] = np.array(self.end_fluxes)
+        return type(self).from_arrays(arrays)
+
+
+def as_forcing(fluxes, pert_value=None, perturbation=None):
+    """
+    returns fluxes if it already is a ForcingSchedule, otherwise builds one
+    from the simulator arguments
+    """
+    if isinstance(fluxes, ForcingSchedule):
+        return fluxes
+    return ForcingSchedule(fluxes, pert_value, perturbation)
+
+
+def fidelity_levels(diversity, fluxes, levels, pert_value=None, perturbation=None, solver="fixed", sparse=None):
+    """
+    returns batch fitness functions of increasing fidelity, for the
+    fidelity_functions of EvolSearch
+    ARGS:
+    levels: list of (maxconv, flux_stride) - relaxation iterations and flux
+            subsampling of each level, lowest fidelity first, e.g. [(10, 4), (30, 2)]
+    the other arguments are those of daisyworld_fitness_batch. With K
+    forcing scenarios the levels run daisyworld_fitness_ensemble_batch.
+    """
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    if forcing.num_scenarios > 1:
+        batch_fitness_function = daisyworld_fitness_ensemble_batch
+    else:
+        batch_fitness_function = daisyworld_fitness_batch
+    return [
+        partial(
+            batch_fitness_function, diversity=diversity, maxconv=maxconv,
+            fluxes=forcing.subsample(flux_stride), solver=solver, sparse=sparse,
+        )
+        for maxconv, flux_stride in levels
+    ]
+
+
+def noise_scenarios(fluxes, num_scenarios, seed=None):
+    """
+    returns num_scenarios copies of fluxes, each with its own draw of the
+    uniform noise used in evolution_example.py, shape (num_scenarios, len(fluxes))
+    """
+    rng = np.random.RandomState(seed)
+    fluxes = np.asarray(fluxes, dtype=float)
+    return fluxes + (-0.5 + rng.random_sample((num_scenarios, len(fluxes)))) / 10
+
+
+def aggregate_scenarios(durations, aggregate):
+    """
+    reduce per-scenario durations along the last axis with "mean", "min" or,
+    for a number q in [0, 1], the q-quantile
+    """
+    if aggregate == "mean":
+        return np.mean(durations, axis=-1)
+    elif aggregate == "min":
+        return np.min(durations, axis=-1)
+    elif np.isscalar(aggregate) and not isinstance(aggregate, str) and 0 <= aggregate <= 1:
+        return np.quantile(durations, aggregate, axis=-1)
+    raise Exception("Unknown scenario aggregate: " + str(aggregate))
+
+
+def daisyworld_fitness_ensemble_batch(discrete_pop, continuous_pop, diversity, maxconv, fluxes, pert_value=None, perturbation=None, aggregate="mean", return_scenarios=False, solver="fixed", sparse=None, stats=None):
+    """
+    Run every genome of a population against K forcing scenarios at once
+
+    fluxes, pert_value and perturbation describe the scenarios as in
+    forcing_scenarios, or fluxes is a ForcingSchedule built from them, e.g.
+    with K noise draws from noise_scenarios or K
+    perturbation timings. The pop_size * K runs go through the batch engine
+    together. aggregate is "mean", "min" or a quantile in [0, 1].
+
+    Returns the aggregated fitness of each individual, or with
+    return_scenarios=True the tuple (fitness, durations) where durations has
+    shape (pop_size, K). solver and sparse are as in daisyworld_fitness_batch,
+    stats is filled per individual with iterations and flux points summed
+    over the scenarios and "converged" only if every scenario converged.
+    """
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    num_scenarios = forcing.num_scenarios
+    pop_size = np.shape(discrete_pop)[0]
+
+    run_stats = {} if stats is not None else None
+    durations, _ = _sweep_batch(
+        np.repeat(discrete_pop, num_scenarios, axis=0),
+        np.repeat(continuous_pop, num_scenarios, axis=0),
+        diversity, maxconv,
+        np.tile(forcing.fluxes, (pop_size, 1)),
+        np.tile(forcing.flux_factor, (pop_size, 1)),
+        np.tile(forcing.end_fluxes, pop_size),
+        solver, sparse, run_stats,
+    )
+    durations = durations.reshape(pop_size, num_scenarios)
+
+    if stats is not None:
+        stats["iterations"] = run_stats["iterations"].reshape(pop_size, num_scenarios).sum(axis=1)
+        stats["flux_points"] = run_stats["flux_points"].reshape(pop_size, num_scenarios).sum(axis=1)
+        stats["converged"] = run_stats["converged"].reshape(pop_size, num_scenarios).all(axis=1)
+
+    fitness = aggregate_scenarios(durations, aggregate)
+    if return_scenarios:
+        return fitness, durations
+    return fitness
+
+
+def daisyworld_fitness_ensemble(food_web, albedos, diversity, maxconv, fluxes, pert_value=None, perturbation=None, aggregate="mean", return_scenarios=False, solver="fixed", sparse=None, stats=None):
+    """
+    Run a single genome against K forcing scenarios at once
+
+    Same as daisyworld_fitness_ensemble_batch for a population of one.
+    Returns the aggregated fitness as a float, or with return_scenarios=True
+    the tuple (fitness, durations) with the K per-scenario durations.
+    """
+    batch_stats = {} if stats is not None else None
+    fitness, durations = daisyworld_fitness_ensemble_batch(
+        np.asarray(food_web)[None], np.asarray(albedos)[None], diversity, maxconv,
+        as_forcing(fluxes, pert_value, perturbation), aggregate=aggregate, return_scenarios=True,
+        solver=solver, sparse=sparse, stats=batch_stats,
+    )
+    if stats is not None:
+        stats["iterations"] = int(batch_stats["iterations"][0])
+        stats["flux_points"] = int(batch_stats["flux_points"][0])
+        stats["converged"] = bool(batch_stats["converged"][0])
+
+    if return_scenarios:
+        return float(fitness[0]), durations[0]
+    return float(fitness[0])
+
+
+def _relax_kernel(predator_ptr, predator_idx, prey_ptr, prey_idx, alb, fluxes, flux_factors, maxconv, started_upper, unstarted_upper, threshold):
+    """
+    Scalar flux sweep used by the jit backend
+
+    The food web is given in CSR form, the predators of species i are
+    predator_idx[predator_ptr[i]:predator_ptr[i + 1]] and its prey likewise,
+    so each step costs the number of links rather than diversity**2. alb
+    holds the species albedos, fluxes the already perturbed flux schedule
+    and flux_factors its flux * SO / SIGMA. The sweep is aborted once the
+    duration bound from started_upper or unstarted_upper (see
+    _duration_bounds) is below threshold, -inf never aborts. Written with plain loops so that Numba can compile it, it also
+    runs as ordinary Python. Returns init_life, end_life, the total number
+    of relaxation iterations, the number of flux points simulated, whether
+    every flux step reached max|darea| <= TOL and whether it was aborted.
+    """
+    diversity = alb.shape[0]
+    area = np.full(diversity, MIN_AREA)
+    darea = np.zeros(diversity)
+
+    init_life = 0.0
+    end_life = 0.0
+    iterations = 0
+    flux_points = 0
+    converged = True
+    aborted = False
+    for j in range(fluxes.shape[0]):
+        flux = fluxes[j]
+        flux_factor = flux_factors[j]
+
+        # Minimum species coverage
+        area_barren = 1.0
+        for i in range(diversity):
+            if area[i] < MIN_AREA:
+                area[i] = MIN_AREA
+            area_barren -= area[i]
+
+        for it in range(maxconv + 1):
+            alb_p = 0.0
+            for i in range(diversity):
+                alb_p += area[i] * alb[i]
+            alb_p += area_barren * ALB_BARREN
+            Tp = np.power(flux_factor * (1 - alb_p), 0.25)
+
+            for i in range(diversity):
+                Td = INSUL * (alb_p - alb[i]) + Tp
+                if Td >= TD_MIN and Td <= TD_MAX and area[i] >= 0.005:
+                    birth = 1 - 0.003265 * (Td - TD_IDEAL) ** 2
+                else:
+                    birth = 0.0
+
+                predators = 0.0
+                for n in range(predator_ptr[i], predator_ptr[i + 1]):
+                    predators += area[predator_idx[n]]
+                prey = 0.0
+                for n in range(prey_ptr[i], prey_ptr[i + 1]):
+                    prey += area[prey_idx[n]]
+                darea[i] = area[i] * (birth * area_barren - DRATE + predators - prey)
+
+            area_barren = 1.0
+            for i in range(diversity):
+                area[i] += (1 / 50) * darea[i]
+                area_barren -= area[i]
+
+        iterations += maxconv + 1
+        flux_points += 1
+        for i in range(diversity):
+            if abs(darea[i]) > TOL:
+                converged = False
+
+        # Check life init, end
+        current_max = 0.0
+        for i in range(diversity):
+            if area[i] > current_max:
+                current_max = area[i]
+        if init_life == 0:
+            if current_max > MIN_AREA:
+                init_life = flux
+        if init_life != 0:
+            if current_max < MIN_AREA:
+                end_life = flux
+        if end_life != 0:
+            break
+
+        # Give up once the duration cannot reach threshold
+        if j < fluxes.shape[0] - 1:
+            if init_life != 0:
+                upper = started_upper[j] - init_life
+            else:
+                upper = unstarted_upper[j]
+            if upper < threshold:
+                aborted = True
+                break
+
+    return init_life, end_life, iterations, flux_points, converged, aborted
+
+
+# compiled on first use by _compiled_kernel, False if Numba is not installed
+_compiled_relax_kernel = None
+
+
+def _compiled_kernel():
+    """
+    returns _relax_kernel compiled with Numba, or None without Numba. The
+    compiled kernel releases the GIL, so it runs in parallel on a thread executor
+    """
+    global _compiled_relax_kernel
+    if _compiled_relax_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _compiled_relax_kernel = False
+        else:
+            _compiled_relax_kernel = njit(cache=True, nogil=True)(_relax_kernel)
+    return _compiled_relax_kernel or None
+
+
+def daisyworld_fitness_jit(food_web, albedos, diversity, maxconv, display, fluxes, pert_value=None, perturbation=None, stats=None, threshold=None):
+    """
+    Run the daisyworld model with the compiled scalar kernel
+
+    Same arguments and return value as daisyworld_fitness. Uses Numba to
+    compile _relax_kernel on first call. Without Numba, or when display is
+    requested, this falls back to daisyworld_fitness_vectorized.
+    """
+    forcing = as_forcing(fluxes, pert_value, perturbation)
+    kernel = _compiled_kernel()
+    if kernel is None or display:
+        if kernel is None:
+            warnings.warn("numba is not installed, jit backend is falling back to numpy")
+        return daisyworld_fitness_vectorized(food_web, albedos, diversity, maxconv, display, forcing, stats=stats, threshold=threshold)
+    if forcing.num_scenarios != 1:
+        raise Exception("daisyworld_fitness_jit takes a single forcing scenario, see daisyworld_fitness_ensemble")
+
+    web = np.array(np.reshape(food_web, (diversity, diversity)))
+    np.fill_diagonal(web, 0)
+    alb = np.asarray(albedos, dtype=float)[web[0]]
+
+    # CSR predator and prey lists, both in ascending species order
+    species, partners = np.nonzero(web == 1)
+    predator_ptr = np.concatenate(([0], np.cumsum(np.bincount(species, minlength=diversity))))
+    order = np.argsort(partners, kind="stable")
+    prey_idx = species[order]
+    prey_ptr = np.concatenate(([0], np.cumsum(np.bincount(partners, minlength=diversity))))
+
+    if threshold is not None:
+        bounds = _duration_bounds(forcing.fluxes, forcing.end_fluxes)
+        started_upper, unstarted_upper = bounds[0][0], bounds[2][0]
+        kernel_threshold = float(threshold)
+    else:
+        started_upper = unstarted_upper = forcing.fluxes[0]
+        kernel_threshold = -np.inf
+
+    init_life, end_life, iterations, flux_points, converged, aborted = kernel(
+        predator_ptr, partners, prey_ptr, prey_idx, alb, forcing.fluxes[0], forcing.flux_factor[0], maxconv,
+        started_upper, unstarted_upper, kernel_threshold,
+    )
+    if stats is not None:
+        stats["iterations"] = int(iterations)
+        stats["flux_points"] = int(flux_points)
+        stats["converged"] = bool(converged)
+
+    if aborted:
+        return _bound_at(bounds, flux_points - 1, init_life)[1], True
+
+    if end_life == 0:
+        end_life = forcing.end_fluxes[0]
+
+    if threshold is not None:
+        return end_life - init_life, False
+    return end_life - init_life
+
+
+def canonical_genotype(food_web, albedos, diversity):
+    """
+    Map a genotype to the inputs the simulation actually uses
+
+    The diagonal of the food web is zeroed before the run, and species
+    albedos are only read from the albedo genes indexed by row 0 of the web.
+    Returns (food_web, albedos) with the diagonal cleared and every albedo
+    gene that is never read set to 0, so two genotypes that give the same
+    simulation have the same canonical form.
+    """
+    web = np.array(np.reshape(food_web, (diversity, diversity)))
+    np.fill_diagonal(web, 0)
+
+    albedos = np.asarray(albedos)
+    used = np.unique(web[0])
+    canonical_albedos = np.zeros_like(albedos)
+    canonical_albedos[used] = albedos[used]
+
+    return web.reshape(np.shape(food_web)), canonical_albedos
@@ -0,0 +1,190 @@
+"""
+Asynchronous steady-state version of the evolutionary search
+
+There is no generation barrier. As soon as a worker returns a fitness the
+individual is inserted into the population, a new offspring is bred from the
+current elites and submitted, so every worker is kept busy no matter how long
+individual evaluations take.
+"""
+import queue
+
+import numpy as np
+from multiprocess import Pool
+
+from EvolSearch_mixed import EvolSearch
+from Executor import worker_count
+
+# fitness function and its argument in a worker process, set by _set_fitness_function
+_worker = {}
+
+
+def _set_fitness_function(fitness_function, optional_args):
+    """
+    pool initializer, sends the fitness function to each worker once
+    """
+    _worker["fitness_function"] = fitness_function
+    _worker["optional_args"] = optional_args
+
+
+def _evaluate_genotype(task_id, discrete_genotype, continuous_genotype):
+    """
+    evaluate one genotype in a worker process
+    """
+    fitness_function = _worker["fitness_function"]
+    optional_args = _worker["optional_args"]
+    if optional_args:
+        return task_id, fitness_function(discrete_genotype, continuous_genotype, optional_args[0])
+    return task_id, fitness_function(discrete_genotype, continuous_genotype)
+
+
+class AsyncEvolSearch(EvolSearch):
+    def __init__(self, evol_params, discrete_initial_pop, continuous_initial_pop):
+        """
+        Initialize asynchronous evolutionary search, takes the same evol_params
+        as EvolSearch. fitness_args, if given, must have length 1 and
+        batch_fitness_function, shared_memory and packed_discrete are ignored.
+
+        Offspring are bred by copying a random elite (one of the top
+        elitist_fraction evaluated individuals) and applying the EvolSearch
+        mutation. A returned offspring replaces the worst individual of the
+        population if it is fitter.
+        """
+        evol_params = dict(evol_params)
+        evol_params.pop("batch_fitness_function", None)
+        evol_params.pop("shared_memory", None)
+        evol_params.pop("packed_discrete", None)
+        if "fitness_args" in evol_params.keys():
+            assert (
+                len(evol_params["fitness_args"]) == 1
+            ), "AsyncEvolSearch only supports fitness args of length 1."
+
+        super().__init__(evol_params, discrete_initial_pop, continuous_initial_pop)
+
+        self.fitness = np.full(self.pop_size, -np.inf)
+        self.evaluated = np.zeros(self.pop_size, dtype=bool)
+        self.num_evaluations = 0
+
+    def start_pool(self):
+        """
+        create the worker pool, tasks are submitted one genotype at a time
+        """
+        # one genotype in flight per worker, at most os.cpu_count() of them
+        self.num_workers = worker_count(self.num_processes)
+        self.pool = Pool(
+            self.num_workers,
+            initializer=_set_fitness_function,
+            initargs=(self.fitness_function, self.optional_args),
+        )
+        self.results = queue.Queue()
+        # task id -> (slot in the population or -1 for offspring, discrete genotype, continuous genotype)
+        self.pending = {}
+        self.next_task_id = 0
+        self.next_initial = 0
+
+    def submit(self, slot, discrete_genotype, continuous_genotype):
+        """
+        send a genotype to the pool
+        """
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.pending[task_id] = (slot, discrete_genotype, continuous_genotype)
+        self.pool.apply_async(
+            _evaluate_genotype,
+            (task_id, discrete_genotype, continuous_genotype),
+            callback=self.results.put,
+            error_callback=self.results.put,
+        )
+
+    def fill_pool(self):
+        """
+        keep num_workers genotypes in flight, first the initial population
+        and then offspring of the current elites
+        """
+        while len(self.pending) < self.num_workers:
+            if self.next_initial < self.pop_size:
+                slot = self.next_initial
+                self.next_initial += 1
+                self.submit(slot, self.discrete_pop[slot, :].copy(), self.continuous_pop[slot, :].copy())
+            elif np.any(self.evaluated):
+                self.submit(-1, *self.breed())
+            else:
+                # wait for the first initial individual to come back
+                break
+
+    def breed(self):
+        """
+        returns a mutated copy of a random elite
+        """
+        evaluated = np.flatnonzero(self.evaluated)
+        num_elites = min(self.elitist_fraction, len(evaluated))
+        elites = evaluated[np.argsort(self.fitness[evaluated])[-num_elites:]]
+        parent = self.rng.choice(elites)
+
+        # mutated as one-row populations by the operators of EvolSearch.mutation
+        discrete_genotype = self.discrete_pop[parent : parent + 1, :].copy()
+        self.mutate_discrete(discrete_genotype)
+        continuous_genotype = self.continuous_pop[parent : parent + 1, :].copy()
+        self.mutate_continuous(continuous_genotype)
+        np.clip(continuous_genotype, 0, 1, out=continuous_genotype)
+
+        return discrete_genotype[0], continuous_genotype[0]
+
+    def insert(self, slot, discrete_genotype, continuous_genotype, fitness):
+        """
+        put an evaluated genotype into the population
+        """
+        if slot < 0:
+            # offspring replace the worst evaluated individual if they are fitter
+            slot = np.argmin(np.where(self.evaluated, self.fitness, np.inf))
+            if fitness <= self.fitness[slot]:
+                return
+        self.discrete_pop[slot, :] = discrete_genotype
+        self.continuous_pop[slot, :] = continuous_genotype
+        self.fitness[slot] = fitness
+        self.evaluated[slot] = True
+
+    def run(self, num_evaluations):
+        """
+        process num_evaluations returned evaluations, evaluations still in
+        flight carry on in the background
+        """
+        target = self.num_evaluations + num_evaluations
+        self.fill_pool()
+        while self.num_evaluations < target:
+            result = self.results.get()
+            if isinstance(result, BaseException):
+                raise result
+            task_id, fitness = result
+            slot, discrete_genotype, continuous_genotype = self.pending.pop(task_id)
+            self.num_evaluations += 1
+            self.insert(slot, discrete_genotype, continuous_genotype, fitness)
+            self.fill_pool()
+
+    def step_generation(self):
+        """
+        process pop_size evaluations, the steady-state equivalent of a generation
+        """
+        self.run(self.pop_size)
+        self.generation += 1
+
+    def close(self):
+        """
+        stop the workers, evaluations still in flight are discarded
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        super().close()
+
+    def get_mean_fitness(self):
+        """
+        returns the mean fitness of the evaluated individuals
+        """
+        return np.mean(self.fitness[self.evaluated])
+
+    def get_fitness_variance(self):
+        """
+        returns variance of the evaluated individuals' fitness
+        """
+        return np.std(self.fitness[self.evaluated]) ** 2
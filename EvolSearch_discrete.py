@@ -2,16 +2,42 @@
 Contains the multiprocessing evolutionary search class
 Madhavun Candadai
 Jan, 2018
+
+The search over purely discrete genotypes is EvolSearch_mixed.EvolSearch with
+an empty continuous segment, this module keeps its original interface.
 """
-# from multiprocessing import Pool
-import time
+import functools
 import numpy as np
-from pathos.multiprocessing import ProcessPool
+import EvolSearch_mixed
+import PackedGenome
+
+
+def _discrete_only(function, discrete, continuous, *args, **keywords):
+    """
+    call a function of the discrete genotype (or population) alone, dropping
+    the empty continuous one. Keywords such as threshold and stats are forwarded
+    """
+    return function(discrete, *args, **keywords)
+
 
-__evolsearch_process_pool = None
+def _discrete_canonical(canonicalize_function, discrete_genotype, continuous_genotype):
+    """
+    canonical form of a discrete genotype, with the empty continuous genotype
+    """
+    return canonicalize_function(discrete_genotype), continuous_genotype
 
 
-class EvolSearch:
+def _adapt(adapter, function):
+    """
+    returns adapter bound to function. __wrapped__ lets inspect.signature, and
+    so Instrumentation.accepts_keyword, see the keywords function takes
+    """
+    adapted = functools.partial(adapter, function)
+    adapted.__wrapped__ = function
+    return adapted
+
+
+class EvolSearch(EvolSearch_mixed.EvolSearch):
     def __init__(self, evol_params, initial_pop):
         """
         Initialize evolutionary search
@@ -22,11 +48,14 @@ class EvolSearch:
                 genotype_size: int - genotype_size,
                 fitness_function: function - a user-defined function that takes a genotype as arg and returns a float fitness value
                 elitist_fraction: float - fraction of top performing individuals to retain for next generation
-                mutation_variance: float - variance of the gaussian distribution used for mutation noise
+                mutation_variance: float - probability with which each gene is replaced by a random bit
             optional keys -
                 fitness_args: list-like - optional additional arguments to pass while calling fitness function
                                            list such that len(list) == 1 or len(list) == pop_size
                 num_processes: int -  pool size for multiprocessing.pool.Pool - defaults to os.cpu_count()
+                any other optional key of EvolSearch_mixed.EvolSearch. Its batch_fitness_function,
+                fidelity_functions and surrogate_features take the discrete population matrix alone and
+                canonicalize_function maps a genotype to its canonical genotype
         """
         # check for required keys
         required_keys = [
@@ -43,162 +72,37 @@ class EvolSearch:
                     + key
                 )
 
-        # checked for all required keys
-        self.pop_size = evol_params["pop_size"]
         self.genotype_size = evol_params["genotype_size"]
-        self.fitness_function = evol_params["fitness_function"]
-        self.elitist_fraction = int(
-            np.ceil(evol_params["elitist_fraction"] * self.pop_size)
-        )
         self.mutation_variance = evol_params["mutation_variance"]
-
-        # validating fitness function
-        assert self.fitness_function, "Invalid fitness_function"
-        rand_genotype = np.random.rand(self.genotype_size)
-        rand_genotype_fitness = self.fitness_function(rand_genotype)
-        assert (
-            type(rand_genotype_fitness) == type(0.0)
-            or type(rand_genotype_fitness) in np.sctypes["float"]
-        ), "Invalid return type for fitness_function. Should be float or np.dtype('np.float*')"
-
-        # create other required data
-        self.num_processes = evol_params.get("num_processes", None)
-        self.pop = np.copy(initial_pop)  # TODO: Check if initial pop is the right size
-        print(np.shape(initial_pop))
-        self.fitness = np.zeros(self.pop_size)
-        self.num_batches = int(self.pop_size / self.num_processes)
-        self.num_remainder = int(self.pop_size % self.num_processes)
-
-        # check for fitness function kwargs
-        if "fitness_args" in evol_params.keys():
-            optional_args = evol_params["fitness_args"]
-            assert (
-                len(optional_args) == 1 or len(optional_args) == self.pop_size
-            ), "fitness args should be length 1 or pop_size."
-            self.optional_args = optional_args
-        else:
-            self.optional_args = None
-
-        # creating the global process pool to be used across all generations
-        global __evolsearch_process_pool
-        __evolsearch_process_pool = ProcessPool(self.num_processes)
-        time.sleep(0.5)
-
-    def evaluate_fitness(self, individual_index):
-        """
-        Call user defined fitness function and pass genotype
-        """
-        if self.optional_args:
-            if len(self.optional_args) == 1:
-                return self.fitness_function(
-                    self.pop[individual_index, :], self.optional_args[0]
-                )
-            else:
-                return self.fitness_function(
-                    self.pop[individual_index, :], self.optional_args[individual_index]
-                )
-        else:
-            return self.fitness_function(self.pop[individual_index, :])
-
-    def elitist_selection(self):
-        """
-        from fitness select top performing individuals based on elitist_fraction
-        """
-        self.pop = self.pop[np.argsort(self.fitness)[-self.elitist_fraction :], :]
-
-    def mutation(self):
-        """
-        create new pop by repeating mutated copies of elitist individuals
-        """
-        # number of copies of elitists required
-        num_reps = (
-            int((self.pop_size - self.elitist_fraction) / self.elitist_fraction) + 1
-        )
-
-        # creating copies and adding noise
-        mutated_elites = np.tile(self.pop, [num_reps, 1])
-
-        replace_indices = np.random.choice([False, True], size=np.shape(mutated_elites), p=[1-self.mutation_variance, self.mutation_variance])
-        
-        mutated_elites[replace_indices] = np.random.randint(2, size=np.sum(replace_indices))
-        #mutated_elites += np.random.normal(
-        #    loc=0.0,
-        #    scale=self.mutation_variance,
-        #    size=[num_reps * self.elitist_fraction, self.genotype_size],
-        #)
-
-        # concatenating elites with their mutated versions
-        self.pop = np.vstack((self.pop, mutated_elites))
-
-        # clipping to pop_size
-        self.pop = self.pop[: self.pop_size, :]
-
-        #self.pop = np.clip(self.pop, 0, 1)
-
-    def step_generation(self):
-        """
-        evaluate fitness of pop, and create new pop after elitist_selection and mutation
-        """
-        global __evolsearch_process_pool
-
-        if not np.all(self.fitness == 0):
-            # elitist_selection
-            self.elitist_selection()
-
-            # mutation
-            self.mutation()
-
-        # estimate fitness using multiprocessing pool
-        if __evolsearch_process_pool:
-            # pool exists
-            self.fitness = np.asarray(
-                __evolsearch_process_pool.map(
-                    self.evaluate_fitness, np.arange(self.pop_size)
-                )
-            )
-        else:
-            # re-create pool
-            __evolsearch_process_pool = Pool(self.num_processes)
-            self.fitness = np.asarray(
-                __evolsearch_process_pool.map(
-                    self.evaluate_fitness, np.arange(self.pop_size)
-                )
-            )
-
-    def execute_search(self, num_gens):
-        """
-        runs the evolutionary algorithm for given number of generations, num_gens
-        """
-        # step generation num_gens times
-        for gen in np.arange(num_gens):
-            self.step_generation()
-
-    def get_fitnesses(self):
-        """
-        simply return all fitness values of current population
-        """
-        return self.fitness
+        mixed_params = {key: value for key, value in evol_params.items() if key not in ("genotype_size", "mutation_variance")}
+        mixed_params.update({
+            "discrete_genotype_size": self.genotype_size,
+            "continuous_genotype_size": 0,
+            "fitness_function": _adapt(_discrete_only, evol_params["fitness_function"]),
+            "discrete_mutation_probability": self.mutation_variance,
+            "continuous_mutation_variance": 0.0,
+        })
+        # the other callables of EvolSearch_mixed also receive the continuous population
+        for key in ("batch_fitness_function", "surrogate_features"):
+            if evol_params.get(key) is not None:
+                mixed_params[key] = _adapt(_discrete_only, evol_params[key])
+        if evol_params.get("fidelity_functions") is not None:
+            mixed_params["fidelity_functions"] = [_adapt(_discrete_only, f) for f in evol_params["fidelity_functions"]]
+        if evol_params.get("canonicalize_function") is not None:
+            mixed_params["canonicalize_function"] = _adapt(_discrete_canonical, evol_params["canonicalize_function"])
+        super().__init__(mixed_params, initial_pop, np.zeros((np.shape(initial_pop)[0], 0)))
+
+    @property
+    def pop(self):
+        """
+        the discrete population matrix, unpacked if packed_discrete is set
+        """
+        if self.packed_discrete:
+            return PackedGenome.unpack(self.discrete_pop, self.discrete_genotype_size)
+        return self.discrete_pop
 
     def get_best_individual(self):
         """
         returns 1D array of the genotype that has max fitness
         """
-        return self.pop[np.argmax(self.fitness), :]
-
-    def get_best_individual_fitness(self):
-        """
-        return the fitness value of the best individual
-        """
-        return np.max(self.fitness)
-
-    def get_mean_fitness(self):
-        """
-        returns the mean fitness of the population
-        """
-        return np.mean(self.fitness)
-
-    def get_fitness_variance(self):
-        """
-        returns variance of the population's fitness
-        """
-        return np.std(self.fitness) ** 2
\ No newline at end of file
+        return np.array(self.discrete_genotype(np.argmax(self.fitness)))
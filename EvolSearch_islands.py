@@ -0,0 +1,241 @@
+"""
+Island model version of the evolutionary search
+
+The population is split into islands, each evolved by its own EvolSearch in
+a dedicated process with its own fitness evaluation. Between migrations the
+islands run independently, every migration_interval generations the best
+individuals of each island migrate to its neighbours on the topology and
+replace their worst individuals.
+"""
+import numpy as np
+from multiprocess import Pipe, Process
+
+from EvolSearch_mixed import EvolSearch
+
+TOPOLOGIES = ("ring", "fully_connected", "random")
+
+
+def _run_island(conn, evol_params, discrete_initial_pop, continuous_initial_pop, seed):
+    """
+    island process, runs an EvolSearch and answers the commands sent by
+    IslandEvolSearch over conn
+    """
+    np.random.seed(seed)
+    search = None
+    try:
+        search = EvolSearch(evol_params, discrete_initial_pop, continuous_initial_pop)
+        conn.send(None)
+        while True:
+            command, args = conn.recv()
+            if command == "close":
+                break
+            try:
+                if command == "run":
+                    # best and mean fitness after each generation
+                    summaries = []
+                    for _ in range(args):
+                        search.step_generation()
+                        summaries.append((search.get_best_individual_fitness(), search.get_mean_fitness()))
+                    conn.send(summaries)
+                elif command == "emigrants":
+                    order = np.argsort(search.fitness)[-args:]
+                    conn.send((search.discrete_pop[order].copy(), search.continuous_pop[order].copy(), search.fitness[order].copy()))
+                elif command == "immigrants":
+                    discrete_pop, continuous_pop, fitness = args
+                    worst = np.argsort(search.fitness)[: len(fitness)]
+                    search.discrete_pop[worst] = discrete_pop
+                    search.continuous_pop[worst] = continuous_pop
+                    search.fitness[worst] = fitness
+                    conn.send(None)
+                elif command == "fitness":
+                    conn.send(search.get_fitnesses())
+                elif command == "best":
+                    discrete_genotype, continuous_genotype = search.get_best_individual()
+                    conn.send((search.get_best_individual_fitness(), discrete_genotype, continuous_genotype))
+            except Exception as e:
+                conn.send(e)
+    except Exception as e:
+        conn.send(e)
+    finally:
+        if search is not None:
+            search.close()
+        conn.close()
+
+
+class IslandEvolSearch:
+    def __init__(self, evol_params, discrete_initial_pop, continuous_initial_pop):
+        """
+        Initialize island model evolutionary search
+        ARGS:
+        evol_params: dict - EvolSearch parameters of each island, pop_size is the island population size
+            island keys -
+                num_islands: int - number of islands, each runs in its own process
+                migration_interval: int - generations between migrations, defaults to 5
+                num_migrants: int - individuals each island sends per migration, defaults to 1
+                topology: str - "ring" (island i sends to island i + 1), "fully_connected" (every
+                                island receives the best num_migrants of all the others' migrants) or
+                                "random" (each island sends to a random other island at every
+                                migration), defaults to "ring"
+        discrete_initial_pop, continuous_initial_pop: ndarray - num_islands * pop_size initial
+                                                                individuals, split in order between islands
+
+        Islands evaluate fitness locally with their own EvolSearch settings, e.g. a
+        batch_fitness_function or a small num_processes per island.
+        """
+        evol_params = dict(evol_params)
+        self.num_islands = evol_params.pop("num_islands")
+        self.migration_interval = evol_params.pop("migration_interval", 5)
+        self.num_migrants = evol_params.pop("num_migrants", 1)
+        self.topology = evol_params.pop("topology", "ring")
+        if self.topology not in TOPOLOGIES:
+            raise Exception("Unknown island topology: " + str(self.topology))
+        assert (
+            0 < self.num_migrants < evol_params["pop_size"]
+        ), "num_migrants should be between 1 and pop_size - 1."
+
+        discrete_initial_pops = np.split(np.asarray(discrete_initial_pop), self.num_islands)
+        continuous_initial_pops = np.split(np.asarray(continuous_initial_pop), self.num_islands)
+
+        self.generation = 0
+        self.best_fitness_history = []
+        self.mean_fitness_history = []
+
+        # each island gets its own random stream, spawned from the seed when one is given
+        island_params = [dict(evol_params) for _ in range(self.num_islands)]
+        if "seed" in evol_params:
+            children = np.random.SeedSequence(evol_params["seed"]).spawn(self.num_islands)
+            seeds = [int(child.generate_state(1)[0] >> 1) for child in children]
+            for params, seed in zip(island_params, seeds):
+                params["seed"] = seed
+        else:
+            seeds = np.random.randint(2 ** 31, size=self.num_islands)
+        self.connections = []
+        self.islands = []
+        for i in range(self.num_islands):
+            conn, island_conn = Pipe()
+            island = Process(
+                target=_run_island,
+                args=(island_conn, island_params[i], discrete_initial_pops[i], continuous_initial_pops[i], seeds[i]),
+            )
+            island.start()
+            self.connections.append(conn)
+            self.islands.append(island)
+        self._gather()
+
+    def _gather(self):
+        """
+        returns the replies of all islands, re-raising island errors
+        """
+        replies = [conn.recv() for conn in self.connections]
+        for reply in replies:
+            if isinstance(reply, BaseException):
+                raise reply
+        return replies
+
+    def _broadcast(self, command, args=None):
+        for conn in self.connections:
+            conn.send((command, args))
+        return self._gather()
+
+    def run(self, num_gens):
+        """
+        evolve every island num_gens generations without synchronizing, and
+        record the global best and mean fitness of each generation
+        """
+        summaries = np.asarray(self._broadcast("run", num_gens))
+        self.best_fitness_history.extend(np.max(summaries[:, :, 0], axis=0))
+        # islands have equal sizes, so the global mean is the mean of island means
+        self.mean_fitness_history.extend(np.mean(summaries[:, :, 1], axis=0))
+        self.generation += num_gens
+
+    def migrate(self):
+        """
+        send the best num_migrants of each island to its neighbours
+        """
+        emigrants = self._broadcast("emigrants", self.num_migrants)
+
+        if self.topology == "ring":
+            sources = [[(i - 1) % self.num_islands] for i in range(self.num_islands)]
+        elif self.topology == "fully_connected":
+            sources = [[j for j in range(self.num_islands) if j != i] for i in range(self.num_islands)]
+        else:
+            sources = [[] for _ in range(self.num_islands)]
+            for j in range(self.num_islands):
+                destination = (j + np.random.randint(1, self.num_islands)) % self.num_islands
+                sources[destination].append(j)
+
+        for i, conn in enumerate(self.connections):
+            if not sources[i]:
+                conn.send(("immigrants", (emigrants[i][0][:0], emigrants[i][1][:0], emigrants[i][2][:0])))
+                continue
+            discrete_pop = np.concatenate([emigrants[j][0] for j in sources[i]])
+            continuous_pop = np.concatenate([emigrants[j][1] for j in sources[i]])
+            fitness = np.concatenate([emigrants[j][2] for j in sources[i]])
+            best = np.argsort(fitness)[-self.num_migrants:]
+            conn.send(("immigrants", (discrete_pop[best], continuous_pop[best], fitness[best])))
+        self._gather()
+
+    def step_generation(self):
+        """
+        evolve every island one generation, migrating every migration_interval generations
+        """
+        self.run(1)
+        if self.num_islands > 1 and self.generation % self.migration_interval == 0:
+            self.migrate()
+
+    def execute_search(self, num_gens):
+        """
+        runs the islands for num_gens generations, synchronizing only to migrate
+        """
+        target = self.generation + num_gens
+        while self.generation < target:
+            until_migration = self.migration_interval - self.generation % self.migration_interval
+            num_run = min(until_migration, target - self.generation)
+            self.run(num_run)
+            if self.num_islands > 1 and self.generation % self.migration_interval == 0:
+                self.migrate()
+
+    def close(self):
+        """
+        stop the island processes
+        """
+        for conn, island in zip(self.connections, self.islands):
+            try:
+                conn.send(("close", None))
+            except (OSError, EOFError):
+                pass
+            island.join()
+            conn.close()
+        self.connections = []
+        self.islands = []
+
+    def get_fitnesses(self):
+        """
+        returns the fitness values of all islands, island after island
+        """
+        return np.concatenate(self._broadcast("fitness"))
+
+    def get_best_individual(self):
+        """
+        returns the genotype with max fitness across all islands
+        """
+        best = max(self._broadcast("best"), key=lambda reply: reply[0])
+        return best[1], best[2]
+
+    def get_best_individual_fitness(self):
+        """
+        return the fitness value of the best individual across all islands
+        """
+        return np.max(self.get_fitnesses())
+
+    def get_mean_fitness(self):
+        """
+        returns the mean fitness over all islands
+        """
+        return np.mean(self.get_fitnesses())
+
+    def get_fitness_variance(self):
+        """
+        returns variance of the fitness over all islands
+        """
+        return np.std(self.get_fitnesses()) ** 2
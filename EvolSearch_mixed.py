@@ -3,18 +3,36 @@ Contains the multiprocessing evolutionary search class
 Madhavun Candadai
 Jan, 2018
 """
-# from multiprocessing import Pool
+import functools
+import json
+import os
+import threading
 import time
 import numpy as np
-from pathos.multiprocessing import ProcessPool
+from Executor import make_executor
+from FitnessCache import FitnessCache, fingerprint
+from SharedPopulation import SharedPopulation, is_array_container
+from DistributedEval import Coordinator
+from Instrumentation import Instrumentation, accepts_keyword, accepts_stats, batch_records, timed_call
+from Surrogate import RidgeSurrogate, genome_features, rank_correlation
+import PackedGenome
 
-__evolsearch_process_pool = None
+# genes drawn per chunk when mutating the unpacked discrete population, bounds
+# the temporary position arrays for very large populations
+MUTATION_CHUNK_GENES = 1 << 24
 
 
 class EvolSearch:
     def __init__(self, evol_params, discrete_initial_pop, continuous_initial_pop):
         """
         Initialize evolutionary search
+
+        The genome has two segments, a discrete one of bits and a continuous
+        one of genes in [0, 1], each stored as a (pop_size, size) matrix.
+        Either segment may have size 0, e.g. EvolSearch_discrete is this class
+        with an empty continuous segment. Selection and mutation work in place
+        on two preallocated buffers per segment, which the population
+        alternates between from one generation to the next.
         ARGS:
         evol_params: dict
             required keys -
@@ -27,6 +45,80 @@ class EvolSearch:
                 fitness_args: list-like - optional additional arguments to pass while calling fitness function
                                            list such that len(list) == 1 or len(list) == pop_size
                 num_processes: int -  pool size for multiprocessing.pool.Pool - defaults to os.cpu_count()
+                executor: str - where fitness is evaluated, "serial" in this process, "thread" on a thread pool
+                                (for fitness functions that release the GIL) or "process" on a pathos process
+                                pool, both with min(num_processes, os.cpu_count()) workers. Defaults to "serial"
+                                with a batch_fitness_function and "process" otherwise
+                chunk_size: int - individuals sent to a pool worker per task, by default sized from the measured
+                                  time of an evaluation and overhead of a task, which also moves the evaluation
+                                  into this process when the population is too cheap to be worth a task
+                batch_fitness_function: function - takes the discrete_pop and continuous_pop matrices and returns
+                                                   an array of pop_size fitness values. When given, the whole population
+                                                   is evaluated with a single call, or a call per chunk on a
+                                                   thread or process executor.
+                                                   It may also return (fitness, scenario_fitness) with a row of
+                                                   per-scenario values for each individual, e.g.
+                                                   daisyworld_fitness_ensemble_batch with return_scenarios=True,
+                                                   which are kept in scenario_fitness
+                fitness_cache_size: int - number of fitness values kept in an in-memory LRU cache keyed by genotype,
+                                          enables the cache
+                fitness_cache_path: str - SQLite file used as a persistent fitness cache across runs, enables the cache
+                canonicalize_function: function - maps (discrete_genotype, continuous_genotype) to the inputs the fitness
+                                                  function actually depends on. Individuals with the same canonical form
+                                                  are evaluated once per generation and share the result
+                shared_memory: bool - keep the population, fitness and the array keywords of fitness_function
+                                      in shared memory for the lifetime of the pool, workers only receive
+                                      index chunks. Call close() to release the blocks
+                instrumentation_path: str - JSON-lines file receiving a record per fitness evaluation (wall time,
+                                            and relaxation iterations, flux points and convergence for fitness
+                                            functions taking a stats keyword) and per generation (select, mutate,
+                                            dispatch and gather times, worker utilization)
+                packed_discrete: bool - store the discrete population bit-packed with np.packbits, one bit per gene.
+                                        Selection, mutation and hashing work on the packed bytes, genotypes are
+                                        unpacked right before they are passed to the fitness function
+                distributed_address: (host, port) - evaluate fitness on DistributedEval workers connecting to a
+                                                    coordinator listening on this address instead of a local pool.
+                                                    The bound address is self.coordinator.address
+                distributed_authkey: bytes - shared secret of the coordinator and its workers, required with
+                                             distributed_address
+                surrogate_fraction: float - enables surrogate pre-screening. A ridge regression fitted on the
+                                            genomes simulated so far ranks the offspring of each generation and
+                                            only this fraction of them, the ones predicted best, is simulated.
+                                            Elites are always simulated, the others get fitness -inf
+                surrogate_exploration: float - fraction of the offspring simulated at random among those not
+                                               predicted best, keeps the surrogate training data unbiased,
+                                               defaults to 0.1
+                surrogate_min_samples: int - simulated genomes needed before screening starts, defaults to pop_size
+                surrogate_alpha: float - ridge penalty of the surrogate, defaults to 1.0
+                surrogate_archive_size: int - most recent simulated genomes the surrogate is fitted on,
+                                              defaults to 5000
+                surrogate_features: function - maps the (unpacked) discrete_pop and continuous_pop matrices to
+                                               the surrogate's feature matrix, defaults to the genes side by side
+                fidelity_functions: list of function - batch fitness functions of increasing fidelity, below
+                                                       the full fidelity of fitness_function, e.g. from
+                                                       EvoDaisy.fidelity_levels. Enables successive halving:
+                                                       the population is scored at the lowest level, the top
+                                                       fidelity_fraction of it at the next level and so on,
+                                                       and only the last ones get a full fidelity evaluation.
+                                                       Elites are always promoted and the others get fitness
+                                                       -inf, so selection only uses full fidelity scores
+                fidelity_fraction: float - fraction of the individuals promoted at each level, defaults to 0.5
+                fidelity_check_size: int - individuals dropped at a low level that are also evaluated at full
+                                           fidelity, at random, so the rank correlation in fidelity_history
+                                           is not limited to the top of the population, defaults to 0
+                abort_hopeless: bool - pass the fitness of the weakest elite as a threshold keyword to fitness
+                                       functions that take one (e.g. daisyworld_fitness), which then return
+                                       (fitness, aborted) and may stop early with a lower bound below the
+                                       threshold. The elites are evaluated again in every generation, so an
+                                       individual that cannot beat the weakest of them is never selected and
+                                       selection stays exact. Aborted values are not cached
+                seed: int - seed of the numpy Generator used for mutation and the other random choices of the
+                            search, defaults to a seed drawn from the numpy global RNG so np.random.seed
+                            still makes a run reproducible
+                validate_fitness_function: bool - call fitness_function on a random genotype before starting
+                                                  the workers to check its return type, defaults to True. Turn
+                                                  it off for short jobs where one extra simulation is a
+                                                  noticeable part of the startup time
         """
         # check for required keys
         required_keys = [
@@ -58,21 +150,31 @@ class EvolSearch:
 
         # validating fitness function
         assert self.fitness_function, "Invalid fitness_function"
-        rand_discrete_genotype = np.random.randint(2, size=self.discrete_genotype_size)
-        rand_continuous_genotype = np.random.rand(self.continuous_genotype_size)
-        rand_genotype_fitness = self.fitness_function(rand_discrete_genotype, rand_continuous_genotype)
-        assert (
-            type(rand_genotype_fitness) == type(0.0)
-            or type(rand_genotype_fitness) in np.sctypes["float"]
-        ), "Invalid return type for fitness_function. Should be float or np.dtype('np.float*')"
+        if evol_params.get("validate_fitness_function", True):
+            rand_discrete_genotype = np.random.randint(2, size=self.discrete_genotype_size)
+            rand_continuous_genotype = np.random.rand(self.continuous_genotype_size)
+            rand_genotype_fitness = self.fitness_function(rand_discrete_genotype, rand_continuous_genotype)
+            assert (
+                type(rand_genotype_fitness) == type(0.0)
+                or type(rand_genotype_fitness) in np.sctypes["float"]
+            ), "Invalid return type for fitness_function. Should be float or np.dtype('np.float*')"
 
         # create other required data
-        self.num_processes = evol_params.get("num_processes", None)
-        self.discrete_pop = np.copy(discrete_initial_pop)
+        self.num_processes = evol_params.get("num_processes", None) or os.cpu_count()
+        self.packed_discrete = evol_params.get("packed_discrete", False)
+        if self.packed_discrete:
+            self.discrete_pop = PackedGenome.pack(discrete_initial_pop)
+        else:
+            self.discrete_pop = np.copy(discrete_initial_pop)
         self.continuous_pop = np.copy(continuous_initial_pop)
         self.fitness = np.zeros(self.pop_size)
-        self.num_batches = int(self.pop_size / self.num_processes)
-        self.num_remainder = int(self.pop_size % self.num_processes)
+        self.generation = 0
+        self.rng = np.random.default_rng(evol_params.get("seed", np.random.randint(2 ** 32, dtype=np.uint64)))
+        # population buffers of each segment, the parent of each offspring and the continuous mutation noise
+        self._buffers = {"discrete_pop": [], "continuous_pop": []}
+        self._offspring_parents = np.arange(self.pop_size - self.elitist_fraction)
+        self._noise = None
+        self.checkpoint_thread = None
 
         # check for fitness function kwargs
         if "fitness_args" in evol_params.keys():
@@ -84,99 +186,786 @@ class EvolSearch:
         else:
             self.optional_args = None
 
-        # creating the global process pool to be used across all generations
-        global __evolsearch_process_pool
-        __evolsearch_process_pool = ProcessPool(self.num_processes)
-        time.sleep(0.5)
+        # cache of fitness values keyed by genotype and fitness function parameters
+        if "fitness_cache_size" in evol_params.keys() or "fitness_cache_path" in evol_params.keys():
+            # a shared fitness argument is part of every key, per-individual ones go in genotype_key
+            shared_args = self.optional_args if self.optional_args and len(self.optional_args) == 1 else None
+            self.fitness_cache = FitnessCache(
+                max_size=evol_params.get("fitness_cache_size", 100000),
+                path=evol_params.get("fitness_cache_path", None),
+                params=(self.fitness_function, evol_params.get("batch_fitness_function", None), shared_args),
+            )
+        else:
+            self.fitness_cache = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # collapsing of equivalent genotypes before evaluation
+        self.canonicalize_function = evol_params.get("canonicalize_function", None)
+        self.num_deduplicated = 0
+        self.dedup_history = []
+
+        # optional surrogate pre-screening of offspring
+        self.surrogate_fraction = evol_params.get("surrogate_fraction", None)
+        if self.surrogate_fraction is not None:
+            self.surrogate = RidgeSurrogate(
+                evol_params.get("surrogate_alpha", 1.0), evol_params.get("surrogate_archive_size", 5000)
+            )
+        else:
+            self.surrogate = None
+        self.surrogate_exploration = evol_params.get("surrogate_exploration", 0.1)
+        self.surrogate_min_samples = evol_params.get("surrogate_min_samples", self.pop_size)
+        self.surrogate_features = evol_params.get("surrogate_features", genome_features)
+        # per generation accuracy of the surrogate and simulations it avoided
+        self.surrogate_history = []
+        self.num_surrogate_avoided = 0
+
+        # optional bound-based abort of individuals that cannot enter the elite
+        self.abort_hopeless = evol_params.get("abort_hopeless", False)
+        self.abort_threshold = None
+        self.aborted = np.zeros(self.pop_size, dtype=bool)
+        self.abort_history = []
+
+        # optional successive halving over fidelity levels, level scores of the
+        # current population are nan where an individual was not scored
+        self.fidelity_functions = list(evol_params.get("fidelity_functions", []))
+        self.fidelity_fraction = evol_params.get("fidelity_fraction", 0.5)
+        self.fidelity_check_size = evol_params.get("fidelity_check_size", 0)
+        self.fidelity_fitness = np.full((self.pop_size, len(self.fidelity_functions)), np.nan)
+        self.fidelity_history = []
+
+        self.batch_fitness_function = evol_params.get("batch_fitness_function", None)
+        # batch evaluation of the whole population does not need a pool by default
+        self.executor_name = evol_params.get("executor", "serial" if self.batch_fitness_function else "process")
+        self.chunk_size = evol_params.get("chunk_size", None)
+
+        # optional instrumentation, timings are always kept for the last generation
+        instrumentation_path = evol_params.get("instrumentation_path", None)
+        if instrumentation_path:
+            self.instrumentation = Instrumentation(instrumentation_path)
+        else:
+            self.instrumentation = None
+        self.generation_timing = {"select": 0.0, "mutate": 0.0, "dispatch": 0.0, "gather": 0.0}
+        self.evaluation_records = []
+
+        # per-scenario fitness of the current population from an ensemble batch function,
+        # rows of individuals not simulated this generation (fitness cache hits) are nan
+        self.scenario_fitness = None
+
+        # creating the workers to be used across all generations
+        self.shared_memory = evol_params.get("shared_memory", False)
+        self.shared_population = None
+        self.distributed_address = evol_params.get("distributed_address", None)
+        self.distributed_authkey = evol_params.get("distributed_authkey", None)
+        self.coordinator = None
+        self.executor = None
+        start = time.perf_counter()
+        self.start_pool()
+        # seconds until the workers were ready to evaluate
+        self.pool_startup_time = time.perf_counter() - start
+
+    def start_pool(self):
+        """
+        create the workers used to evaluate fitness across all generations
+        """
+        # remote workers fed by a TCP coordinator
+        if self.distributed_address and not self.batch_fitness_function:
+            self.coordinator = Coordinator(self.distributed_address, self.distributed_authkey)
+            self.coordinator.set_function(
+                self.fitness_function,
+                self.optional_args,
+                self.discrete_genotype_size if self.packed_discrete else None,
+            )
+            return
+
+        # worker pool attached to shared memory copies of the population
+        if self.shared_memory and not self.batch_fitness_function:
+            self.shared_population = SharedPopulation(
+                self.num_processes,
+                self.fitness_function,
+                self.discrete_pop,
+                self.continuous_pop,
+                self.optional_args,
+                self.discrete_genotype_size if self.packed_discrete else None,
+            )
+            self.share_population()
+            return
+
+        self.executor = make_executor(self.executor_name, self.num_processes, self.chunk_size)
+
+    def discrete_genotype(self, individual_index):
+        """
+        returns the unpacked discrete genotype of an individual
+        """
+        if self.packed_discrete:
+            return PackedGenome.unpack(self.discrete_pop[individual_index, :], self.discrete_genotype_size)
+        return self.discrete_pop[individual_index, :]
+
+    def threshold_keywords(self, function):
+        """
+        returns the threshold keyword to pass to function this generation, if any
+        """
+        if self.abort_threshold is not None and accepts_keyword(function, "threshold"):
+            return {"threshold": self.abort_threshold}
+        return {}
 
     def evaluate_fitness(self, individual_index):
         """
         Call user defined fitness function and pass genotype
         """
+        keywords = self.threshold_keywords(self.fitness_function)
         if self.optional_args:
             if len(self.optional_args) == 1:
                 return self.fitness_function(
-                    self.discrete_pop[individual_index, :], self.continuous_pop[individual_index, :], self.optional_args[0]
+                    self.discrete_genotype(individual_index), self.continuous_pop[individual_index, :], self.optional_args[0],
+                    **keywords
                 )
             else:
                 return self.fitness_function(
-                    self.discrete_pop[individual_index, :], self.continuous_pop[individual_index, :], self.optional_args[individual_index]
+                    self.discrete_genotype(individual_index), self.continuous_pop[individual_index, :], self.optional_args[individual_index],
+                    **keywords
                 )
         else:
-            return self.fitness_function(self.discrete_pop[individual_index, :], self.continuous_pop[individual_index, :])
+            return self.fitness_function(self.discrete_genotype(individual_index), self.continuous_pop[individual_index, :], **keywords)
+
+    def evaluate_fitness_instrumented(self, individual_index):
+        """
+        Call user defined fitness function and return its value and an evaluation record
+        """
+        args = [self.discrete_genotype(individual_index), self.continuous_pop[individual_index, :]]
+        if self.optional_args:
+            if len(self.optional_args) == 1:
+                args.append(self.optional_args[0])
+            else:
+                args.append(self.optional_args[individual_index])
+        value, record = timed_call(
+            self.fitness_function, args, accepts_stats(self.fitness_function), self.threshold_keywords(self.fitness_function)
+        )
+        record["individual"] = int(individual_index)
+        return value, record
+
+    def evaluate_batch(self, indices):
+        """
+        Call the batch fitness function on the individuals at indices, returns
+        their fitness, the aborted flags or per-scenario fitness rows it
+        returned alongside (or None) and their evaluation records (or None)
+        """
+        start = time.perf_counter()
+        discrete_pop = self.discrete_pop[indices, :]
+        if self.packed_discrete:
+            discrete_pop = PackedGenome.unpack(discrete_pop, self.discrete_genotype_size)
+        continuous_pop = self.continuous_pop[indices, :]
+        stats = {}
+        keywords = self.threshold_keywords(self.batch_fitness_function)
+        instrument = self.instrumentation is not None
+        if instrument and accepts_stats(self.batch_fitness_function):
+            keywords["stats"] = stats
+        fitness = self.batch_fitness_function(discrete_pop, continuous_pop, **keywords)
+        extra = None
+        if isinstance(fitness, tuple):
+            # (fitness, aborted) with a threshold, (fitness, scenario_fitness) otherwise
+            fitness, extra = fitness
+            extra = np.asarray(extra)
+        records = None
+        if instrument:
+            records = batch_records(stats, time.perf_counter() - start, len(indices))
+            for i, record in zip(indices, records):
+                record["individual"] = int(i)
+        return np.asarray(fitness, dtype=float), extra, records
+
+    def __getstate__(self):
+        # pathos pickles the search with every task, the buffers and executor stay in this process
+        state = self.__dict__.copy()
+        state["_buffers"] = {name: [] for name in self._buffers}
+        state["_noise"] = None
+        state["executor"] = None
+        # the fitness cache is only used here, its SQLite connection cannot be pickled
+        state["fitness_cache"] = None
+        # workers only evaluate fitness, the surrogate archive and records of
+        # past generations stay in this process
+        state["surrogate"] = None
+        state["fidelity_fitness"] = None
+        state["scenario_fitness"] = None
+        state["evaluation_records"] = []
+        for name in state:
+            if name.endswith("_history"):
+                state[name] = []
+        return state
+
+    def share_population(self):
+        """
+        move the population and fitness into the shared memory blocks, the
+        two shared buffers of each segment become its population buffers
+        """
+        for name in ("discrete_pop", "continuous_pop"):
+            buffers = self.shared_population.buffers(name)
+            pop = getattr(self, name)
+            if not any(pop is buffer for buffer in buffers):
+                buffers[0][...] = pop
+                setattr(self, name, buffers[0])
+            self._buffers[name] = buffers
+        fitness = self.shared_population.arrays["fitness"]
+        if self.fitness is not fitness:
+            fitness[...] = self.fitness
+            self.fitness = fitness
+
+    def population_buffer(self, name):
+        """
+        returns a (pop_size, size) buffer for the segment name ("discrete_pop"
+        or "continuous_pop") that does not overlap its current population,
+        allocating one the first two times
+        """
+        pop = getattr(self, name)
+        for buffer in self._buffers[name]:
+            if buffer.dtype == pop.dtype and buffer.shape[1:] == pop.shape[1:] and not np.may_share_memory(buffer, pop):
+                return buffer
+        buffer = np.empty((self.pop_size,) + pop.shape[1:], dtype=pop.dtype)
+        self._buffers[name] = self._buffers[name][-1:] + [buffer]
+        return buffer
 
     def elitist_selection(self):
         """
         from fitness select top performing individuals based on elitist_fraction
-        """
-        self.discrete_pop = self.discrete_pop[np.argsort(self.fitness)[-self.elitist_fraction :], :]
-        self.continuous_pop = self.continuous_pop[np.argsort(self.fitness)[-self.elitist_fraction :], :]
 
+        The elites are found with a partial sort and gathered, in ascending
+        order of fitness, into the first rows of a population buffer.
+        """
+        elites = np.argpartition(self.fitness, -self.elitist_fraction)[-self.elitist_fraction :]
+        elites = elites[np.argsort(self.fitness[elites])]
+        for name in ("discrete_pop", "continuous_pop"):
+            buffer = self.population_buffer(name)
+            np.take(getattr(self, name), elites, axis=0, out=buffer[: self.elitist_fraction])
+            setattr(self, name, buffer[: self.elitist_fraction])
 
     def mutation(self):
         """
         create new pop by repeating mutated copies of elitist individuals
+
+        Offspring i is a copy of elite i % elitist_fraction. The copies are
+        written behind the elites in their buffer and mutated in place, only
+        the mutated discrete positions are drawn.
         """
-        # number of copies of elitists required
-        num_reps = (
-            int((self.pop_size - self.elitist_fraction) / self.elitist_fraction) + 1
-        )
+        for name in ("discrete_pop", "continuous_pop"):
+            elites = getattr(self, name)
+            buffer = elites.base
+            if not any(buffer is b for b in self._buffers[name]):
+                # elites not produced by elitist_selection, e.g. restored from a checkpoint
+                buffer = self.population_buffer(name)
+                buffer[: self.elitist_fraction] = elites
+            np.take(buffer[: self.elitist_fraction], self._offspring_parents, axis=0,
+                    out=buffer[self.elitist_fraction :], mode="wrap")
+            setattr(self, name, buffer)
+
+        self.mutate_discrete(self.discrete_pop[self.elitist_fraction :])
+        self.mutate_continuous(self.continuous_pop[self.elitist_fraction :])
+        # clipping continuous pop to [0,1]
+        np.clip(self.continuous_pop, 0, 1, out=self.continuous_pop)
+
+    def mutate_discrete(self, offspring):
+        """
+        in place, replace each gene of the C-contiguous discrete offspring rows
+        (packed if packed_discrete is set) with a random bit with probability
+        discrete_mutation_probability. Only the mutated positions are drawn
+        """
+        if offspring.size == 0:
+            return
+        if self.packed_discrete:
+            rows = max(1, MUTATION_CHUNK_GENES // self.discrete_genotype_size)
+            for start in range(0, len(offspring), rows):
+                PackedGenome.mutate(offspring[start : start + rows], self.discrete_genotype_size,
+                                    self.discrete_mutation_probability, self.rng)
+        else:
+            genes = offspring.reshape(-1)
+            for start in range(0, genes.size, MUTATION_CHUNK_GENES):
+                chunk = genes[start : start + MUTATION_CHUNK_GENES]
+                positions = PackedGenome.mutation_positions(chunk.size, self.discrete_mutation_probability, self.rng)
+                chunk[positions] = self.rng.integers(2, size=len(positions), dtype=chunk.dtype)
 
-        # creating copies and adding noise
-        mutated_discrete_elites = np.tile(self.discrete_pop, [num_reps, 1])
+    def mutate_continuous(self, offspring):
+        """
+        in place, add gaussian noise of scale continuous_mutation_variance to
+        the continuous offspring rows, the caller clips them to [0, 1]
+        """
+        if offspring.size == 0:
+            return
+        if self._noise is None or self._noise.shape != offspring.shape:
+            self._noise = np.empty(offspring.shape)
+        self.rng.standard_normal(out=self._noise)
+        self._noise *= self.continuous_mutation_variance
+        offspring += self._noise
 
-        replace_indices = np.random.choice([False, True], size=np.shape(mutated_discrete_elites), p=[1-self.discrete_mutation_probability, self.discrete_mutation_probability])
-        
-        mutated_discrete_elites[replace_indices] = np.random.randint(2, size=np.sum(replace_indices))
+    def evaluate_population(self, indices):
+        """
+        returns the fitness of the individuals at indices, computed in batch
+        calls or one individual at a time, on the executor or the workers
+        """
+        if len(indices) == 0:
+            return np.zeros(0)
 
-        mutated_continuous_elites = np.tile(self.continuous_pop, [num_reps, 1])
+        instrument = self.instrumentation is not None
 
-        mutated_continuous_elites += np.random.normal(
-            loc=0.0,
-            scale=self.continuous_mutation_variance,
-            size=[num_reps * self.elitist_fraction, self.continuous_genotype_size],
-        )
+        # estimate fitness of the population in a batch call per chunk
+        if self.batch_fitness_function:
+            chunks = self.executor.map(self.evaluate_batch, np.asarray(indices), self.generation_timing, batched=True)
+            fitness, extras, records = zip(*chunks)
+            if extras[0] is not None:
+                extra = np.concatenate(extras)
+                if "threshold" in self.threshold_keywords(self.batch_fitness_function):
+                    self.aborted[indices] = extra
+                else:
+                    scenario_fitness = np.asarray(extra, dtype=float)
+                    if self.scenario_fitness is None or self.scenario_fitness.shape[1] != scenario_fitness.shape[1]:
+                        self.scenario_fitness = np.full((self.pop_size, scenario_fitness.shape[1]), np.nan)
+                    self.scenario_fitness[indices] = scenario_fitness
+            if instrument:
+                for chunk_records in records:
+                    self.evaluation_records.extend(chunk_records)
+            return np.concatenate(fitness)
 
-        # concatenating elites with their mutated versions
-        self.discrete_pop = np.vstack((self.discrete_pop, mutated_discrete_elites))
-        self.continuous_pop = np.vstack((self.continuous_pop, mutated_continuous_elites))
+        threshold = self.threshold_keywords(self.fitness_function).get("threshold")
 
-        # clipping to pop_size
-        self.discrete_pop = self.discrete_pop[: self.pop_size, :]
-        self.continuous_pop = self.continuous_pop[: self.pop_size, :]
+        # estimate fitness on distributed workers
+        if self.coordinator:
+            fitness, aborted = self.coordinator.evaluate(
+                self.discrete_pop, self.continuous_pop, indices, self.generation_timing, threshold
+            )
+            self.aborted[indices] = aborted
+            return fitness
 
-        # clipping continuous pop to [0,1]
-        self.continuous_pop = np.clip(self.continuous_pop, 0, 1)
+        # estimate fitness on workers attached to the shared population
+        if self.shared_population:
+            fitness, aborted, records = self.shared_population.evaluate(
+                self.discrete_pop, self.continuous_pop, indices, instrument, self.generation_timing, threshold
+            )
+            self.aborted[indices] = aborted
+            self.evaluation_records.extend(records)
+            return fitness
+
+        # estimate fitness one individual at a time on the executor
+        if instrument:
+            values = self.executor.map(self.evaluate_fitness_instrumented, indices, self.generation_timing)
+        else:
+            values = self.executor.map(self.evaluate_fitness, indices, self.generation_timing)
+
+        if instrument:
+            values, records = zip(*values)
+            self.evaluation_records.extend(records)
+        if threshold is not None:
+            values, aborted = zip(*values)
+            self.aborted[indices] = aborted
+        return np.asarray(values)
+
+    def genotype_key(self, individual_index):
+        """
+        returns a key identifying the fitness of an individual, built from its
+        canonical genotype when a canonicalize_function is given. Packed
+        genotypes are hashed as packed bytes unless they need canonicalizing.
+        """
+        discrete_genotype = self.discrete_pop[individual_index, :]
+        continuous_genotype = self.continuous_pop[individual_index, :]
+        if self.canonicalize_function:
+            discrete_genotype = self.discrete_genotype(individual_index)
+            discrete_genotype, continuous_genotype = self.canonicalize_function(
+                discrete_genotype, continuous_genotype
+            )
+
+        extra = ()
+        if self.optional_args and len(self.optional_args) != 1:
+            extra = (self.optional_args[individual_index],)
+
+        if self.fitness_cache is not None:
+            return self.fitness_cache.key(discrete_genotype, continuous_genotype, *extra)
+        return fingerprint((np.asarray(discrete_genotype), np.asarray(continuous_genotype)) + extra)
+
+    def evaluate_deduplicated(self, indices=None):
+        """
+        returns the fitness of the individuals at indices (all of pop by
+        default), evaluating one representative of each group of equivalent
+        individuals and skipping those found in the fitness cache
+        """
+        if indices is None:
+            indices = np.arange(self.pop_size)
+        keys = {i: self.genotype_key(i) for i in indices}
+        representatives = {}
+        for i, key in keys.items():
+            representatives.setdefault(key, i)
+        self.num_deduplicated = len(indices) - len(representatives)
+        self.dedup_history.append(self.num_deduplicated)
+
+        # only evaluate representatives that are not in the cache
+        values = {}
+        missing = []
+        for key, i in representatives.items():
+            if self.fitness_cache is not None:
+                value = self.fitness_cache.get(key)
+                if value is not None:
+                    values[key] = value
+                    continue
+            missing.append(i)
+        missing = np.asarray(missing, dtype=int)
+
+        for i, value in zip(missing, self.evaluate_population(missing)):
+            values[keys[i]] = value
+            # an aborted value is only a bound below this generation's threshold
+            if self.fitness_cache is not None and not self.aborted[i]:
+                self.fitness_cache.put(keys[i], value)
+
+        # duplicates share the per-scenario values and abort flag of their representative
+        if self.scenario_fitness is not None:
+            for i, key in keys.items():
+                self.scenario_fitness[i] = self.scenario_fitness[representatives[key]]
+        for i, key in keys.items():
+            self.aborted[i] = self.aborted[representatives[key]]
+
+        if self.fitness_cache is not None:
+            self.fitness_cache.flush()
+            self.cache_hits = self.fitness_cache.hits
+            self.cache_misses = self.fitness_cache.misses
+
+        return np.array([values[keys[i]] for i in indices], dtype=float)
+
+    def population_features(self, indices):
+        """
+        returns the surrogate features of the individuals at indices
+        """
+        discrete_pop = self.discrete_pop[indices, :]
+        if self.packed_discrete:
+            discrete_pop = PackedGenome.unpack(discrete_pop, self.discrete_genotype_size)
+        return self.surrogate_features(discrete_pop, self.continuous_pop[indices, :])
+
+    def screen_offspring(self):
+        """
+        returns the indices of the individuals to simulate this generation and
+        the surrogate predictions for the offspring, or None when the surrogate
+        is not yet trained. The elites (the first elitist_fraction rows after
+        mutation), the offspring predicted best and a random exploration quota
+        of the remaining offspring are simulated.
+        """
+        if self.surrogate.num_samples < self.surrogate_min_samples or np.all(self.fitness == 0):
+            return np.arange(self.pop_size), None
+
+        offspring = np.arange(self.elitist_fraction, self.pop_size)
+        self.surrogate.fit()
+        predicted = self.surrogate.predict(self.population_features(offspring))
+
+        num_best = int(np.ceil(self.surrogate_fraction * len(offspring)))
+        order = np.argsort(predicted)[::-1]
+        rest = offspring[order[num_best:]]
+        num_explore = min(len(rest), int(np.ceil(self.surrogate_exploration * len(offspring))))
+        explore = self.rng.choice(rest, size=num_explore, replace=False)
+
+        indices = np.concatenate((np.arange(self.elitist_fraction), offspring[order[:num_best]], explore))
+        return np.sort(indices), predicted
+
+    def update_surrogate(self, indices, predicted):
+        """
+        add the individuals simulated this generation to the surrogate archive
+        and record how well the surrogate predicted the simulated offspring
+        """
+        # aborted values are only bounds, the surrogate learns from complete simulations
+        trained = indices[~self.aborted[indices]]
+        self.surrogate.add(self.population_features(trained), self.fitness[trained])
+        if predicted is None:
+            return
+
+        offspring = trained[trained >= self.elitist_fraction]
+        predicted = predicted[offspring - self.elitist_fraction]
+        actual = self.fitness[offspring]
+        num_avoided = self.pop_size - len(indices)
+        self.num_surrogate_avoided += num_avoided
+        self.surrogate_history.append({
+            "generation": self.generation,
+            "rank_correlation": rank_correlation(predicted, actual),
+            "rmse": float(np.sqrt(np.mean((predicted - actual) ** 2))),
+            "simulated": len(indices),
+            "avoided": num_avoided,
+            "avoided_fraction": num_avoided / self.pop_size,
+        })
+
+    def successive_halving(self, indices):
+        """
+        score the individuals at indices with each of fidelity_functions in
+        turn, promoting the top fidelity_fraction of each level to the next
+        one, and return the indices to evaluate at full fidelity. Elites (the
+        first elitist_fraction rows after mutation) are always promoted and at
+        least elitist_fraction individuals reach full fidelity.
+        """
+        self.fidelity_fitness[...] = np.nan
+        evolved = not np.all(self.fitness == 0)
+        candidates = np.asarray(indices)
+        for level, function in enumerate(self.fidelity_functions):
+            discrete_pop = self.discrete_pop[candidates, :]
+            if self.packed_discrete:
+                discrete_pop = PackedGenome.unpack(discrete_pop, self.discrete_genotype_size)
+            values = function(discrete_pop, self.continuous_pop[candidates, :])
+            if isinstance(values, tuple):
+                values = values[0]
+            values = np.asarray(values, dtype=float)
+            self.fidelity_fitness[candidates, level] = values
+
+            num_promoted = max(int(np.ceil(self.fidelity_fraction * len(candidates))), self.elitist_fraction)
+            promoted = np.zeros(len(candidates), dtype=bool)
+            promoted[np.argsort(values)[::-1][:num_promoted]] = True
+            if evolved:
+                promoted |= candidates < self.elitist_fraction
+            candidates = candidates[promoted]
+
+        dropped = np.setdiff1d(indices, candidates)
+        num_checked = min(self.fidelity_check_size, len(dropped))
+        checked = self.rng.choice(dropped, size=num_checked, replace=False)
+        return np.sort(np.concatenate((candidates, checked)))
+
+    def record_fidelity(self, indices, full_indices):
+        """
+        record the evaluations made at each fidelity level this generation and
+        the rank correlation of each level with the full fidelity fitness
+        """
+        evaluations = [int(np.sum(~np.isnan(self.fidelity_fitness[:, level])))
+                       for level in range(len(self.fidelity_functions))]
+        scored = full_indices[~self.aborted[full_indices]]
+        correlations = []
+        for level in range(len(self.fidelity_functions)):
+            # fidelity checks dropped at a lower level have no score at this one
+            level_scored = scored[~np.isnan(self.fidelity_fitness[scored, level])]
+            correlations.append(rank_correlation(self.fidelity_fitness[level_scored, level], self.fitness[level_scored]))
+        self.fidelity_history.append({
+            "generation": self.generation,
+            "evaluations": evaluations + [len(full_indices)],
+            "full_fraction": len(full_indices) / max(len(indices), 1),
+            "rank_correlation": correlations,
+        })
 
     def step_generation(self):
         """
         evaluate fitness of pop, and create new pop after elitist_selection and mutation
         """
-        global __evolsearch_process_pool
+        self.generation_timing = {"select": 0.0, "mutate": 0.0, "dispatch": 0.0, "gather": 0.0}
+        self.evaluation_records = []
+        start = time.perf_counter()
 
+        self.abort_threshold = None
         if not np.all(self.fitness == 0):
+            # the weakest elite is evaluated again below, nothing under it can be selected
+            if self.abort_hopeless:
+                threshold = np.sort(self.fitness)[-self.elitist_fraction]
+                if np.isfinite(threshold):
+                    self.abort_threshold = float(threshold)
+
             # elitist_selection
             self.elitist_selection()
+            selected = time.perf_counter()
 
             # mutation
             self.mutation()
+            self.generation_timing["select"] = selected - start
+            self.generation_timing["mutate"] = time.perf_counter() - selected
 
-        # estimate fitness using multiprocessing pool
-        if __evolsearch_process_pool:
-            # pool exists
-            self.fitness = np.asarray(
-                __evolsearch_process_pool.map(
-                    self.evaluate_fitness, np.arange(self.pop_size)
-                )
-            )
+        if self.scenario_fitness is not None:
+            self.scenario_fitness[...] = np.nan
+
+        indices = np.arange(self.pop_size)
+        predicted = None
+        if self.surrogate is not None:
+            indices, predicted = self.screen_offspring()
+        screened = indices
+        if self.fidelity_functions:
+            indices = self.successive_halving(indices)
+
+        # individuals screened out by the surrogate or at a low fidelity are never selected
+        self.aborted[...] = False
+        if self.shared_population:
+            # the fitness of the previous population is no longer needed
+            fitness = self.fitness
+            fitness[...] = -np.inf
+        else:
+            fitness = np.full(self.pop_size, -np.inf)
+        if self.fitness_cache is None and not self.canonicalize_function:
+            fitness[indices] = self.evaluate_population(indices)
         else:
-            # re-create pool
-            __evolsearch_process_pool = Pool(self.num_processes)
-            self.fitness = np.asarray(
-                __evolsearch_process_pool.map(
-                    self.evaluate_fitness, np.arange(self.pop_size)
+            fitness[indices] = self.evaluate_deduplicated(indices)
+        self.fitness = fitness
+
+        if self.surrogate is not None:
+            self.update_surrogate(indices, predicted)
+        if self.fidelity_functions:
+            self.record_fidelity(screened, indices)
+        if self.abort_hopeless:
+            self.abort_history.append(int(np.sum(self.aborted)))
+
+        self.generation += 1
+
+        if self.instrumentation is not None:
+            self.write_instrumentation(time.perf_counter() - start)
+
+    def write_instrumentation(self, wall_time):
+        """
+        write the evaluation records and timings of the last generation
+        """
+        for record in self.evaluation_records:
+            self.instrumentation.write("evaluation", generation=self.generation, **record)
+
+        # utilization of the workers while results were being computed
+        busy_time = sum(record["wall_time"] for record in self.evaluation_records)
+        if self.executor:
+            num_workers = self.executor.num_workers
+        elif self.shared_population:
+            num_workers = self.shared_population.num_processes
+        else:
+            num_workers = self.num_processes
+        evaluation_time = self.generation_timing["dispatch"] + self.generation_timing["gather"]
+        if evaluation_time > 0:
+            utilization = busy_time / (num_workers * evaluation_time)
+        else:
+            utilization = None
+
+        screening = {}
+        if self.abort_hopeless:
+            screening["aborted"] = int(np.sum(self.aborted))
+        if self.surrogate_history and self.surrogate_history[-1]["generation"] == self.generation - 1:
+            screening["surrogate_rank_correlation"] = self.surrogate_history[-1]["rank_correlation"]
+            screening["simulations_avoided"] = self.surrogate_history[-1]["avoided"]
+
+        self.instrumentation.write(
+            "generation",
+            generation=self.generation,
+            wall_time=wall_time,
+            evaluations=len(self.evaluation_records),
+            busy_time=busy_time,
+            utilization=utilization,
+            **screening,
+            **self.generation_timing
+        )
+        self.instrumentation.flush()
+
+    def save_checkpoint(self, path, background=False):
+        """
+        save the full search state to a compressed npz file at path
+
+        The checkpoint holds the population matrices, fitness, generation
+        count, the states of the search's Generator and of the numpy global
+        RNG and the array keywords (e.g. the
+        noisy fluxes or a ForcingSchedule) of the fitness function partials. The file is written
+        to a temporary name and moved into place, so an interrupted write
+        never leaves a broken checkpoint. With background=True the state is
+        copied and written on a separate thread.
+        """
+        rng_state = np.random.get_state()
+        state = {
+            "discrete_pop": np.copy(self.discrete_pop),
+            "continuous_pop": np.copy(self.continuous_pop),
+            "fitness": np.copy(self.fitness),
+            "generation": np.asarray(self.generation),
+            "rng_keys": rng_state[1],
+            "rng_pos": np.asarray(rng_state[2]),
+            "rng_has_gauss": np.asarray(rng_state[3]),
+            "rng_cached_gaussian": np.asarray(rng_state[4]),
+            "generator_state": np.asarray(json.dumps(self.rng.bit_generator.state)),
+        }
+        if self.abort_hopeless:
+            state["aborted"] = np.copy(self.aborted)
+        if self.surrogate is not None and self.surrogate.num_samples:
+            state["surrogate_features"] = np.copy(self.surrogate.features)
+            state["surrogate_fitness"] = np.copy(self.surrogate.fitness)
+        for prefix, function in (("fitness_kw_", self.fitness_function), ("batch_kw_", self.batch_fitness_function)):
+            if isinstance(function, functools.partial):
+                for name, value in function.keywords.items():
+                    if isinstance(value, np.ndarray):
+                        state[prefix + name] = np.copy(value)
+                    elif is_array_container(value):
+                        # stored as prefix + name.field, the class is taken from the current keyword on load
+                        for field, array in value.arrays().items():
+                            state["%s%s.%s" % (prefix, name, field)] = np.copy(array)
+
+        # only one checkpoint is written at a time so they land in order
+        self.wait_for_checkpoint()
+        if background:
+            self.checkpoint_thread = threading.Thread(target=_write_checkpoint, args=(path, state))
+            self.checkpoint_thread.start()
+        else:
+            _write_checkpoint(path, state)
+
+    def wait_for_checkpoint(self):
+        """
+        block until a background checkpoint write has finished
+        """
+        if self.checkpoint_thread is not None:
+            self.checkpoint_thread.join()
+            self.checkpoint_thread = None
+
+    def load_checkpoint(self, path):
+        """
+        restore the search state written by save_checkpoint, the next call to
+        step_generation continues exactly where the saved run stopped
+        """
+        with np.load(path) as checkpoint:
+            self.discrete_pop = checkpoint["discrete_pop"]
+            self.continuous_pop = checkpoint["continuous_pop"]
+            self.fitness = checkpoint["fitness"]
+            self.generation = int(checkpoint["generation"])
+            np.random.set_state(
+                (
+                    "MT19937",
+                    checkpoint["rng_keys"],
+                    int(checkpoint["rng_pos"]),
+                    int(checkpoint["rng_has_gauss"]),
+                    float(checkpoint["rng_cached_gaussian"]),
                 )
             )
+            if "generator_state" in checkpoint.files:
+                self.rng.bit_generator.state = json.loads(str(checkpoint["generator_state"]))
+
+            if "aborted" in checkpoint.files:
+                self.aborted = checkpoint["aborted"]
+            if self.surrogate is not None and "surrogate_fitness" in checkpoint.files:
+                self.surrogate.features = checkpoint["surrogate_features"]
+                self.surrogate.fitness = checkpoint["surrogate_fitness"]
+
+            # restore the array keywords of the fitness function partials
+            keywords = _checkpoint_keywords(checkpoint, "fitness_kw_", self.fitness_function)
+            batch_keywords = _checkpoint_keywords(checkpoint, "batch_kw_", self.batch_fitness_function)
+
+        if self.shared_population:
+            self.share_population()
+        if keywords:
+            self.fitness_function = functools.partial(self.fitness_function, **keywords)
+            if self.shared_population:
+                for name, value in keywords.items():
+                    if is_array_container(value):
+                        for field, array in value.arrays().items():
+                            self.shared_population.arrays["kw_%s.%s" % (name, field)][...] = array
+                    else:
+                        self.shared_population.arrays["kw_" + name][...] = value
+            if self.coordinator:
+                self.coordinator.set_function(
+                    self.fitness_function,
+                    self.optional_args,
+                    self.discrete_genotype_size if self.packed_discrete else None,
+                )
+        if batch_keywords:
+            self.batch_fitness_function = functools.partial(self.batch_fitness_function, **batch_keywords)
+
+    def close(self):
+        """
+        release the shared memory population and its workers, stop the
+        distributed workers or the executor's pool, if any
+        """
+        self.wait_for_checkpoint()
+        if self.instrumentation is not None:
+            self.instrumentation.close()
+        if self.shared_population:
+            # the population stays readable after the shared blocks are released
+            self.discrete_pop = np.copy(self.discrete_pop)
+            self.continuous_pop = np.copy(self.continuous_pop)
+            self.fitness = np.copy(self.fitness)
+            self._buffers = {name: [] for name in self._buffers}
+            self.shared_population.close()
+            self.shared_population = None
+        if self.coordinator:
+            self.coordinator.close()
+            self.coordinator = None
+        if self.executor:
+            self.executor.close()
+            self.executor = None
 
     def execute_search(self, num_gens):
         """
@@ -195,9 +984,14 @@ class EvolSearch:
     def get_best_individual(self):
         """
         returns 1D array of the genotype that has max fitness
+
+        The arrays are copies, the population buffers are reused by later generations.
         """
         best_individual_index = np.argmax(self.fitness)
-        return self.discrete_pop[best_individual_index, :], self.continuous_pop[best_individual_index, :]
+        return (
+            np.array(self.discrete_genotype(best_individual_index)),
+            self.continuous_pop[best_individual_index, :].copy(),
+        )
 
     def get_best_individual_fitness(self):
         """
@@ -207,12 +1001,47 @@ class EvolSearch:
 
     def get_mean_fitness(self):
         """
-        returns the mean fitness of the population
+        returns the mean fitness of the population, individuals not simulated
+        because of surrogate screening or aborted are left out
         """
-        return np.mean(self.fitness)
+        return np.mean(self.fitness[np.isfinite(self.fitness) & ~self.aborted])
 
     def get_fitness_variance(self):
         """
-        returns variance of the population's fitness
+        returns variance of the population's fitness, individuals not simulated
+        because of surrogate screening or aborted are left out
         """
-        return np.std(self.fitness) ** 2
\ No newline at end of file
+        return np.std(self.fitness[np.isfinite(self.fitness) & ~self.aborted]) ** 2
+
+
+def _checkpoint_keywords(checkpoint, prefix, function):
+    """
+    returns the keywords of function saved in checkpoint under prefix, array
+    containers are rebuilt with the class of the keyword they replace
+    """
+    keywords = {}
+    fields = {}
+    for key in checkpoint.files:
+        if not key.startswith(prefix):
+            continue
+        name = key[len(prefix):]
+        if "." in name:
+            name, field = name.split(".", 1)
+            fields.setdefault(name, {})[field] = checkpoint[key]
+        else:
+            keywords[name] = checkpoint[key]
+    for name, arrays in fields.items():
+        keywords[name] = type(function.keywords[name]).from_arrays(arrays)
+    return keywords
+
+
+def _write_checkpoint(path, state):
+    """
+    atomically write the arrays in state to path as a compressed npz file
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
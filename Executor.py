@@ -0,0 +1,229 @@
+"""
+Executors that evaluate a function over the individuals of a population
+
+EvolSearch hands the individuals to evaluate to one of:
+    SerialExecutor - calls the function in this process
+    ThreadExecutor - a thread pool, for fitness functions that release the GIL
+                     such as batched NumPy kernels or the nogil Numba kernel
+    ProcessExecutor - a pathos process pool
+The pools send the individuals in chunks. The chunk size follows from the
+measured time of an evaluation and the measured overhead of a task: chunks
+are large enough that the overhead stays a small part of each task, and a
+population too cheap to be worth a single task is evaluated in this process.
+"""
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathos.multiprocessing import ProcessPool
+
+
+def _warm_up(_):
+    """
+    no-op task mapped once over the pool so that the executor starts with every worker running
+    """
+    return os.getpid()
+
+
+def _call_chunk(function, chunk, batched):
+    """
+    returns the results of function over chunk and the seconds they took,
+    one result per item or, with batched, the result of one call on the chunk
+    """
+    start = time.perf_counter()
+    if batched:
+        results = function(chunk)
+    else:
+        results = [function(item) for item in chunk]
+    return results, time.perf_counter() - start
+
+
+def _collect(outputs, batched):
+    """
+    returns the results of the chunks in order, flattened unless batched, and their total time
+    """
+    results = []
+    busy_time = 0.0
+    for chunk_results, elapsed in outputs:
+        if batched:
+            results.append(chunk_results)
+        else:
+            results.extend(chunk_results)
+        busy_time += elapsed
+    return results, busy_time
+
+
+def _average(previous, value):
+    """
+    running estimate of a cost that may drift from generation to generation
+    """
+    if previous is None:
+        return value
+    return 0.5 * (previous + value)
+
+
+class SerialExecutor:
+    name = "serial"
+    num_workers = 1
+
+    def __init__(self):
+        self.chunk_size = None
+        self.item_time = None
+
+    def map(self, function, items, timing=None, batched=False):
+        """
+        returns function applied to each of items or, with batched, a list
+        holding function applied to all of items. timing, a dict with
+        "dispatch" and "gather" keys, is incremented by the time spent
+        """
+        results, elapsed = _call_chunk(function, items, batched)
+        self.chunk_size = len(items)
+        if len(items):
+            self.item_time = elapsed / len(items)
+        if timing is not None:
+            # computed in this process, it is all gather time
+            timing["gather"] += elapsed
+        return [results] if batched else results
+
+    def close(self):
+        pass
+
+
+class PoolExecutor(SerialExecutor):
+    def __init__(self, num_workers, chunk_size=None, tasks_per_worker=4, max_overhead=0.1):
+        """
+        ARGS:
+        num_workers: int - number of workers of the pool
+        chunk_size: int - items per task, sized automatically when None
+        tasks_per_worker: int - tasks per worker the automatic chunk size aims at, for load balance,
+                                as long as the task overhead allows
+        max_overhead: float - largest fraction of a task's time the automatic chunk size lets the
+                              task overhead take
+        """
+        super().__init__()
+        self.num_workers = num_workers
+        self.fixed_chunk_size = chunk_size
+        self.tasks_per_worker = tasks_per_worker
+        self.max_overhead = max_overhead
+        # seconds of overhead per task (dispatch, pickling, scheduling), measured on the pool
+        self.task_overhead = None
+
+    def plan_chunk_size(self, num_items):
+        """
+        returns the number of items per task, 0 when evaluating num_items in
+        this process is estimated to be faster than on the pool
+        """
+        if self.fixed_chunk_size:
+            return self.fixed_chunk_size
+        largest = math.ceil(num_items / self.num_workers)
+        balanced = math.ceil(num_items / (self.tasks_per_worker * self.num_workers))
+        if self.item_time is None or self.task_overhead is None:
+            return balanced
+
+        # the pool saves at most a (1 - 1 / num_workers) fraction of the serial time
+        if self.task_overhead >= num_items * self.item_time * (1 - 1 / self.num_workers):
+            return 0
+        amortized = math.ceil(self.task_overhead / (self.max_overhead * max(self.item_time, 1e-9)))
+        return max(1, min(max(balanced, amortized), largest))
+
+    def map(self, function, items, timing=None, batched=False):
+        """
+        returns function applied to each of items or, with batched, a list
+        holding function applied to each chunk of items in turn. timing, a
+        dict with "dispatch" and "gather" keys, is incremented by the time spent
+        """
+        num_items = len(items)
+        chunk_size = self.plan_chunk_size(num_items) if num_items else 0
+        if chunk_size == 0:
+            item_time, task_overhead = self.item_time, self.task_overhead
+            results = super().map(function, items, timing, batched)
+            # keep the pool estimates, only the evaluation time is measured here
+            self.task_overhead = task_overhead
+            self.item_time = _average(item_time, self.item_time)
+            return results
+
+        chunks = [items[start : start + chunk_size] for start in range(0, num_items, chunk_size)]
+        start = time.perf_counter()
+        pending = self.submit(function, chunks, batched)
+        dispatched = time.perf_counter()
+        results, busy_time = _collect(self.gather(pending), batched)
+        wall_time = time.perf_counter() - start
+        if timing is not None:
+            timing["dispatch"] += dispatched - start
+            timing["gather"] += wall_time - (dispatched - start)
+
+        # update the cost estimates the chunk size is planned from
+        concurrency = min(self.num_workers, len(chunks))
+        task_overhead = max(0.0, wall_time - busy_time / concurrency) * concurrency / len(chunks)
+        self.chunk_size = chunk_size
+        self.item_time = _average(self.item_time, busy_time / num_items)
+        self.task_overhead = _average(self.task_overhead, task_overhead)
+        return results
+
+
+class ThreadExecutor(PoolExecutor):
+    name = "thread"
+
+    def __init__(self, num_workers, chunk_size=None, **kwargs):
+        super().__init__(num_workers, chunk_size, **kwargs)
+        self.pool = ThreadPoolExecutor(num_workers)
+
+    def submit(self, function, chunks, batched):
+        return [self.pool.submit(_call_chunk, function, chunk, batched) for chunk in chunks]
+
+    def gather(self, pending):
+        return [future.result() for future in pending]
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class ProcessExecutor(PoolExecutor):
+    name = "process"
+
+    def __init__(self, num_workers, chunk_size=None, **kwargs):
+        super().__init__(num_workers, chunk_size, **kwargs)
+        self.pool = ProcessPool(num_workers)
+        # wait for every worker to come up instead of sleeping a fixed time
+        self.pool.map(_warm_up, range(num_workers))
+
+    def submit(self, function, chunks, batched):
+        return self.pool.amap(_call_chunk, [function] * len(chunks), chunks, [batched] * len(chunks))
+
+    def gather(self, pending):
+        return pending.get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.pool.clear()
+
+
+def worker_count(num_workers=None):
+    """
+    returns num_workers capped at os.cpu_count(), os.cpu_count() when None.
+    More worker processes than cores only add scheduling overhead
+    """
+    num_cpus = os.cpu_count() or 1
+    return min(num_workers or num_cpus, num_cpus)
+
+
+EXECUTORS = {
+    "serial": SerialExecutor,
+    "thread": ThreadExecutor,
+    "process": ProcessExecutor,
+}
+
+
+def make_executor(name, num_workers=None, chunk_size=None):
+    """
+    returns the executor called name ("serial", "thread" or "process") with
+    num_workers workers, at most os.cpu_count(). A pool of one worker is a
+    SerialExecutor.
+    """
+    if name not in EXECUTORS:
+        raise Exception("Unknown executor: " + str(name))
+    num_workers = worker_count(num_workers)
+    if name == "serial" or num_workers == 1:
+        return SerialExecutor()
+    return EXECUTORS[name](num_workers, chunk_size)
@@ -0,0 +1,154 @@
+"""
+Content addressed fitness cache for EvolSearch
+
+Fitness values are keyed by a hash of the discrete genotype, the continuous
+genotype and the parameters of the fitness function, so an individual that
+comes back unchanged (a retained elite or a mutated copy that did not
+actually mutate) is not simulated again. Entries are kept in memory with
+least recently used eviction and can optionally be persisted to SQLite so
+that repeated runs also get hits.
+"""
+import functools
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _update_fingerprint(h, value):
+    """
+    feed a stable description of value into the hash h
+    """
+    if isinstance(value, functools.partial):
+        h.update(b"partial(")
+        _update_fingerprint(h, value.func)
+        for arg in value.args:
+            _update_fingerprint(h, arg)
+        for name in sorted(value.keywords):
+            h.update(name.encode())
+            _update_fingerprint(h, value.keywords[name])
+        h.update(b")")
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(str(value.dtype).encode())
+        h.update(str(value.shape).encode())
+        h.update(value.tobytes())
+    elif hasattr(value, "arrays") and hasattr(type(value), "from_arrays"):
+        # array containers such as EvoDaisy.ForcingSchedule
+        h.update(type(value).__qualname__.encode())
+        for name, array in sorted(value.arrays().items()):
+            h.update(name.encode())
+            _update_fingerprint(h, array)
+    elif callable(value):
+        h.update(getattr(value, "__module__", "").encode())
+        h.update(getattr(value, "__qualname__", repr(value)).encode())
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for v in value:
+            _update_fingerprint(h, v)
+        h.update(b"]")
+    else:
+        h.update(repr(value).encode())
+    h.update(b";")
+
+
+def fingerprint(value):
+    """
+    returns a hex digest describing value. functools.partial objects are
+    described by their function and bound arguments and arrays by their
+    contents, so two separately built but equal fitness functions match.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    _update_fingerprint(h, value)
+    return h.hexdigest()
+
+
+class FitnessCache:
+    def __init__(self, max_size=100000, path=None, params=None):
+        """
+        ARGS:
+        max_size: int - maximum number of entries held in memory
+        path: str - optional SQLite file used as a persistent store
+        params: any - fitness function and/or its parameters, included in every key
+        """
+        self.max_size = max_size
+        self.path = path
+        self.params_fingerprint = fingerprint(params).encode()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS fitness (key TEXT PRIMARY KEY, value REAL)"
+            )
+            self.db.commit()
+        else:
+            self.db = None
+
+    def key(self, discrete_genotype, continuous_genotype, *extra):
+        """
+        returns the cache key of an individual
+        """
+        h = hashlib.blake2b(self.params_fingerprint, digest_size=16)
+        for genotype in (discrete_genotype, continuous_genotype):
+            _update_fingerprint(h, np.asarray(genotype))
+        for value in extra:
+            _update_fingerprint(h, value)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        returns the cached fitness for key, or None on a miss
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.db is not None:
+            row = self.db.execute(
+                "SELECT value FROM fitness WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._remember(key, row[0])
+                self.hits += 1
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        store a fitness value, persistent writes are committed by flush()
+        """
+        value = float(value)
+        self._remember(key, value)
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO fitness (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        """
+        commit pending writes to the persistent store
+        """
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,108 @@
+"""
+Optional instrumentation of fitness evaluations and generations
+
+Records are written one JSON object per line. Evaluation records hold the
+wall time of a single fitness call and, for fitness functions taking a
+stats keyword such as daisyworld_fitness, the relaxation iterations, the
+number of flux points simulated before the end_life break and whether the
+relaxation converged. Generation records hold the time spent in selection,
+mutation, dispatching work and gathering results, and worker utilization.
+"""
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+
+# stats entries copied into evaluation records
+STATS_KEYS = ("iterations", "flux_points", "converged")
+
+
+def accepts_keyword(function, keyword):
+    """
+    returns True if function takes the given keyword argument
+    """
+    if function is None:
+        return False
+    try:
+        return keyword in inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def accepts_stats(function):
+    """
+    returns True if function takes a stats keyword argument
+    """
+    return accepts_keyword(function, "stats")
+
+
+def _plain(value):
+    """
+    convert numpy scalars to plain Python values for json
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def timed_call(fitness_function, args, pass_stats, keywords=None):
+    """
+    call fitness_function(*args, **keywords) and return its value and an evaluation record
+    """
+    stats = {} if pass_stats else None
+    keywords = dict(keywords or {})
+    if pass_stats:
+        keywords["stats"] = stats
+    start = time.perf_counter()
+    value = fitness_function(*args, **keywords)
+    record = {"wall_time": time.perf_counter() - start, "pid": os.getpid()}
+    if stats:
+        for key in STATS_KEYS:
+            if key in stats:
+                record[key] = _plain(stats[key])
+    return value, record
+
+
+def batch_records(stats, wall_time, num_individuals):
+    """
+    evaluation records of a batch call, wall time is shared out evenly
+    """
+    records = []
+    for i in range(num_individuals):
+        record = {"wall_time": wall_time / num_individuals, "pid": os.getpid()}
+        for key in STATS_KEYS:
+            if key in stats:
+                record[key] = _plain(stats[key][i])
+        records.append(record)
+    return records
+
+
+class Instrumentation:
+    def __init__(self, path):
+        """
+        stream records to the JSON-lines file at path, appending to it
+        """
+        self.path = path
+        self.file = open(path, "a")
+
+    def write(self, record_type, **fields):
+        """
+        write one record
+        """
+        record = {"type": record_type, "time": time.time()}
+        record.update({key: _plain(value) for key, value in fields.items()})
+        self.file.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __getstate__(self):
+        # the search object is pickled into pool workers, which never write
+        return {"path": self.path, "file": None}
@@ -0,0 +1,68 @@
+"""
+Bit-packed storage of discrete 0/1 genotypes
+
+A population of discrete genotypes is stored as np.packbits rows, one bit per
+gene instead of one int64, which cuts memory and pickling by 64x. Mutation
+works directly on the packed bytes, genotypes are only unpacked right before
+they are passed to the fitness function.
+"""
+import numpy as np
+
+
+def pack(discrete_pop):
+    """
+    returns the (pop_size, ceil(genotype_size / 8)) uint8 packing of a 0/1 population
+    """
+    return np.packbits(np.asarray(discrete_pop) != 0, axis=-1)
+
+
+def unpack(packed_pop, genotype_size):
+    """
+    returns the 0/1 int genotypes of a packed population or a single packed row
+    """
+    return np.unpackbits(packed_pop, axis=-1, count=genotype_size).astype(int)
+
+
+def mutation_positions(num_bits, probability, rng=None):
+    """
+    returns the sorted positions, out of num_bits, that each mutate
+    independently with the given probability. The gaps between mutated bits
+    are geometric, so only the mutated positions are ever drawn. rng is a
+    numpy Generator, by default one seeded from the global numpy RNG.
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+    if probability <= 0 or num_bits == 0:
+        return np.zeros(0, dtype=np.int64)
+    if probability >= 1:
+        return np.arange(num_bits, dtype=np.int64)
+
+    expected = num_bits * probability
+    batch_size = int(expected + 6 * np.sqrt(expected) + 16)
+    positions = np.cumsum(rng.geometric(probability, size=batch_size)) - 1
+    while positions[-1] < num_bits:
+        more = np.cumsum(rng.geometric(probability, size=batch_size)) + positions[-1]
+        positions = np.concatenate((positions, more))
+    return positions[positions < num_bits]
+
+
+def mutate(packed_pop, genotype_size, probability, rng=None):
+    """
+    in place, replace each gene of a packed population with a random bit with
+    the given probability, like EvolSearch.mutation does for unpacked
+    genotypes. packed_pop must be C-contiguous, rng is as in mutation_positions.
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+    pop_size, row_bytes = packed_pop.shape
+    positions = mutation_positions(pop_size * genotype_size, probability, rng)
+
+    rows = positions // genotype_size
+    genes = positions % genotype_size
+    byte_index = rows * row_bytes + (genes >> 3)
+    masks = (128 >> (genes & 7)).astype(np.uint8)
+    new_bits = rng.integers(2, size=len(positions), dtype=np.uint8)
+
+    flat = packed_pop.reshape(-1)
+    np.bitwise_and.at(flat, byte_index, ~masks)
+    np.bitwise_or.at(flat, byte_index, masks * new_bits)
@@ -0,0 +1,232 @@
+"""
+Shared memory population buffers for EvolSearch worker processes
+
+The population matrices, the fitness vector and the array keywords of the
+fitness function (e.g. the fluxes schedule of a partial wrapping
+daisyworld_fitness, or the arrays of a ForcingSchedule) are placed in multiprocessing.shared_memory blocks that
+live as long as the pool. Workers attach to them once when the pool starts,
+afterwards each generation only sends chunks of individual indices and the
+workers write fitness values straight into the shared fitness array.
+
+Each population matrix has two blocks, the double buffer EvolSearch selects
+and mutates into, so the population itself lives in shared memory and each
+generation only tells the workers which of the two blocks to read.
+"""
+import functools
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from multiprocess import Pool
+
+from Executor import worker_count
+from Instrumentation import accepts_stats, timed_call
+import PackedGenome
+
+# state of a worker process, set up once by _attach_worker
+_worker = {}
+
+
+def _attach_block(spec):
+    """
+    attach to a shared memory block described by (name, shape, dtype) and
+    return the block and an ndarray view of it
+    """
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def is_array_container(value):
+    """
+    returns True for objects made of arrays that can be rebuilt from them,
+    such as EvoDaisy.ForcingSchedule, with arrays() and cls.from_arrays()
+    """
+    return hasattr(value, "arrays") and hasattr(type(value), "from_arrays")
+
+
+def _attach_worker(specs, fitness_function, array_keywords, container_keywords, optional_args, discrete_genotype_size):
+    """
+    pool initializer, attaches the shared blocks and rebuilds the fitness
+    function with its array keywords pointing at shared memory
+    """
+    blocks = {}
+    arrays = {}
+    for key, spec in specs.items():
+        blocks[key], arrays[key] = _attach_block(spec)
+
+    if array_keywords or container_keywords:
+        keywords = {name: arrays["kw_" + name] for name in array_keywords}
+        for name, (cls, fields) in container_keywords.items():
+            keywords[name] = cls.from_arrays({field: arrays["kw_%s.%s" % (name, field)] for field in fields})
+        fitness_function = functools.partial(fitness_function, **keywords)
+
+    _worker["blocks"] = blocks
+    _worker["arrays"] = arrays
+    _worker["fitness_function"] = fitness_function
+    _worker["optional_args"] = optional_args
+    _worker["discrete_genotype_size"] = discrete_genotype_size
+    _worker["pass_stats"] = accepts_stats(fitness_function)
+
+
+def _evaluate_indices(task):
+    """
+    evaluate the individuals at indices and write their fitness into shared
+    memory, task is (indices, instrument, threshold, discrete_key,
+    continuous_key), the keys naming the blocks that hold the population. A threshold is passed to
+    the fitness function, which then returns (fitness, aborted). Returns the
+    indices of aborted individuals and the evaluation records when
+    instrument is set.
+    """
+    indices, instrument, threshold, discrete_key, continuous_key = task
+    keywords = {"threshold": threshold} if threshold is not None else {}
+    arrays = _worker["arrays"]
+    fitness_function = _worker["fitness_function"]
+    optional_args = _worker["optional_args"]
+    discrete_genotype_size = _worker["discrete_genotype_size"]
+    discrete_pop = arrays[discrete_key]
+    continuous_pop = arrays[continuous_key]
+    fitness = arrays["fitness"]
+
+    records = []
+    aborted = []
+    for i in indices:
+        discrete_genotype = discrete_pop[i, :]
+        if discrete_genotype_size is not None:
+            discrete_genotype = PackedGenome.unpack(discrete_genotype, discrete_genotype_size)
+        args = [discrete_genotype, continuous_pop[i, :]]
+        if optional_args:
+            if len(optional_args) == 1:
+                args.append(optional_args[0])
+            else:
+                args.append(optional_args[i])
+        if instrument:
+            value, record = timed_call(fitness_function, args, _worker["pass_stats"], keywords)
+            record["individual"] = int(i)
+            records.append(record)
+        else:
+            value = fitness_function(*args, **keywords)
+        if threshold is not None:
+            value, flag = value
+            if flag:
+                aborted.append(i)
+        fitness[i] = value
+    return aborted, records
+
+
+class SharedPopulation:
+    def __init__(self, num_processes, fitness_function, discrete_pop, continuous_pop, optional_args=None,
+                 discrete_genotype_size=None):
+        """
+        Create the shared blocks and the worker pool
+        ARGS:
+        num_processes: int - number of worker processes, at most os.cpu_count()
+        fitness_function: function - called as fitness_function(discrete_genotype, continuous_genotype[, arg]).
+                                     ndarray keywords of a functools.partial are moved to shared memory
+        discrete_pop, continuous_pop: ndarray - population matrices, fix the shape and dtype of the buffers
+                                                and are copied into the first buffer of each
+        optional_args: list-like - fitness_args of EvolSearch
+        discrete_genotype_size: int - set when discrete_pop is bit-packed, workers unpack genotypes to this size
+        """
+        self.num_processes = worker_count(num_processes)
+        self.blocks = {}
+        self.arrays = {}
+
+        for name, pop in (("discrete_pop", discrete_pop), ("continuous_pop", continuous_pop)):
+            self._create(name + ".0", pop)
+            self._create(name + ".1", pop)
+        self._create("fitness", np.zeros(np.shape(discrete_pop)[0]))
+
+        # split the array keywords off the fitness function, workers get them from shared memory
+        array_keywords = []
+        container_keywords = {}
+        if isinstance(fitness_function, functools.partial):
+            keywords = dict(fitness_function.keywords)
+            for name, value in fitness_function.keywords.items():
+                if isinstance(value, np.ndarray):
+                    self._create("kw_" + name, value)
+                    array_keywords.append(name)
+                    del keywords[name]
+                elif is_array_container(value):
+                    fields = value.arrays()
+                    for field, array in fields.items():
+                        self._create("kw_%s.%s" % (name, field), array)
+                    container_keywords[name] = (type(value), list(fields))
+                    del keywords[name]
+            fitness_function = functools.partial(
+                fitness_function.func, *fitness_function.args, **keywords
+            )
+
+        specs = {
+            key: (block.name, self.arrays[key].shape, self.arrays[key].dtype.str)
+            for key, block in self.blocks.items()
+        }
+        self.pool = Pool(
+            self.num_processes,
+            initializer=_attach_worker,
+            initargs=(specs, fitness_function, array_keywords, container_keywords, optional_args, discrete_genotype_size),
+        )
+
+    def _create(self, key, array):
+        array = np.asarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        self.blocks[key] = block
+        self.arrays[key] = view
+
+    def buffers(self, name):
+        """
+        returns the two shared buffers of the population matrix name ("discrete_pop" or "continuous_pop")
+        """
+        return [self.arrays[name + ".0"], self.arrays[name + ".1"]]
+
+    def _block_key(self, name, pop):
+        """
+        returns the key of the shared buffer of name that pop is, copying pop
+        into the first buffer when it is not one of them
+        """
+        for key in (name + ".0", name + ".1"):
+            if pop is self.arrays[key]:
+                return key
+        self.arrays[name + ".0"][...] = pop
+        return name + ".0"
+
+    def evaluate(self, discrete_pop, continuous_pop, indices, instrument=False, timing=None, threshold=None):
+        """
+        return the fitness of the individuals at indices, which of them were
+        aborted and their evaluation records (empty unless instrument is set).
+        Populations held in the shared buffers are read in place, others are
+        copied in first. Workers only receive chunks of indices and the names
+        of the blocks to read. If timing is a dict the dispatch and gather
+        times are added to it. A threshold is passed on to the fitness
+        function, see EvolSearch abort_hopeless.
+        """
+        start = time.perf_counter()
+        keys = (self._block_key("discrete_pop", discrete_pop), self._block_key("continuous_pop", continuous_pop))
+
+        chunks = [c for c in np.array_split(indices, self.num_processes) if len(c)]
+        result = self.pool.map_async(_evaluate_indices, [(c, instrument, threshold) + keys for c in chunks])
+        dispatched = time.perf_counter()
+        results = result.get()
+        records = [record for _, chunk_records in results for record in chunk_records]
+        aborted = np.isin(indices, [i for chunk_aborted, _ in results for i in chunk_aborted])
+
+        if timing is not None:
+            timing["dispatch"] += dispatched - start
+            timing["gather"] += time.perf_counter() - dispatched
+        return self.arrays["fitness"][indices].copy(), aborted, records
+
+    def close(self):
+        """
+        stop the workers and release the shared blocks
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
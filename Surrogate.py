@@ -0,0 +1,92 @@
+"""
+Surrogate fitness model for pre-screening offspring in EvolSearch
+
+A ridge regression, fitted in NumPy on an archive of (genome features,
+fitness) pairs from earlier simulations, predicts the fitness of new
+offspring. EvolSearch simulates only the offspring predicted best plus a
+random exploration quota and leaves the rest unsimulated.
+"""
+import numpy as np
+
+
+def genome_features(discrete_pop, continuous_pop):
+    """
+    default surrogate features, the discrete and continuous genes side by side
+    """
+    return np.hstack((np.asarray(discrete_pop, dtype=float), np.asarray(continuous_pop, dtype=float)))
+
+
+def average_ranks(values):
+    """
+    returns the rank of each of values, tied values share the mean of their ranks
+    """
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    first = np.cumsum(counts) - counts
+    return (first + (counts - 1) / 2.0)[inverse]
+
+
+def rank_correlation(a, b):
+    """
+    returns the Spearman rank correlation of a and b, nan if either is constant.
+    Ties get average ranks, daisyworld durations are often exactly equal
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if len(a) < 2:
+        return np.nan
+    if np.ptp(a) == 0 or np.ptp(b) == 0:
+        return np.nan
+    return float(np.corrcoef(average_ranks(a), average_ranks(b))[0, 1])
+
+
+class RidgeSurrogate:
+    def __init__(self, alpha=1.0, max_archive=5000):
+        """
+        ARGS:
+        alpha: float - ridge penalty on the feature weights
+        max_archive: int - number of most recent samples the model is fitted on
+        """
+        self.alpha = alpha
+        self.max_archive = max_archive
+        self.features = None
+        self.fitness = None
+        self.weights = None
+        self.feature_mean = None
+        self.fitness_mean = 0.0
+
+    @property
+    def num_samples(self):
+        return 0 if self.fitness is None else len(self.fitness)
+
+    def add(self, features, fitness):
+        """
+        append simulated samples to the archive, dropping the oldest beyond max_archive
+        """
+        features = np.asarray(features, dtype=float)
+        fitness = np.asarray(fitness, dtype=float)
+        if self.features is not None:
+            features = np.vstack((self.features, features))
+            fitness = np.concatenate((self.fitness, fitness))
+        self.features = features[-self.max_archive:]
+        self.fitness = fitness[-self.max_archive:]
+
+    def fit(self):
+        """
+        fit the ridge weights to the archive, solving the smaller of the
+        primal (features x features) and dual (samples x samples) systems
+        """
+        self.feature_mean = np.mean(self.features, axis=0)
+        self.fitness_mean = np.mean(self.fitness)
+        X = self.features - self.feature_mean
+        y = self.fitness - self.fitness_mean
+        num_samples, num_features = X.shape
+        if num_features <= num_samples:
+            self.weights = np.linalg.solve(X.T @ X + self.alpha * np.eye(num_features), X.T @ y)
+        else:
+            self.weights = X.T @ np.linalg.solve(X @ X.T + self.alpha * np.eye(num_samples), y)
+
+    def predict(self, features):
+        """
+        returns the predicted fitness of each row of features
+        """
+        return (np.asarray(features, dtype=float) - self.feature_mean) @ self.weights + self.fitness_mean
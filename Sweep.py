@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""
+Parameter sweeps of the daisyworld evolution
+
+A sweep is a list of configurations, each a dict of the settings that
+evolution_example.py hard-codes (see DEFAULT_CONFIG), given as an explicit
+list or expanded from a grid with expand_grid. Every configuration is run on
+a process pool and its best and mean fitness curves and final best genome are
+stored in a SQLite database keyed by a hash of the full configuration.
+Configurations already completed in the database are skipped, so a sweep can
+be extended with new points or restarted after an interruption and only the
+missing runs are done. With a checkpoint directory, runs that were cut off
+continue from their last generation.
+
+    python Sweep.py grid.json --db sweep.db --processes 8
+
+where grid.json holds {"grid": {...}, "base": {...}} or a list of configurations.
+"""
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import os
+import sqlite3
+import time
+from functools import partial
+
+import numpy as np
+from pathos.multiprocessing import ProcessPool
+
+from EvoDaisy import ForcingSchedule, canonical_genotype, daisyworld_fitness_batch, daisyworld_fitness_vectorized
+from EvoDaisy import daisyworld_fitness_ensemble, daisyworld_fitness_ensemble_batch
+from EvolSearch_mixed import EvolSearch
+
+# settings of a run, a configuration overrides any of them
+DEFAULT_CONFIG = {
+    "diversity": 30,
+    "maxconv": 100,
+    "flux_start": 0.0,
+    "flux_stop": 3.0,
+    "flux_step": 0.02,
+    "perturbation": -1.0,
+    "pert_value": list(range(125, 150)),
+    # width of the uniform noise added to the fluxes, 0 for none
+    "noise": 0.1,
+    # more than one scores genomes by their mean duration over that many noise draws
+    "num_scenarios": 1,
+    "pop_size": 200,
+    "num_gens": 20,
+    "elitist_fraction": 0.1,
+    "discrete_mutation_probability": 0.1,
+    "continuous_mutation_variance": 0.1,
+    "seed": 0,
+}
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, range, tuple)):
+        return list(value)
+    raise TypeError("Configuration value is not JSON serializable: " + repr(value))
+
+
+def normalize_config(config):
+    """
+    returns config completed with DEFAULT_CONFIG and converted to plain JSON
+    types, so equal settings always give the same config_key
+    """
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise Exception("Unknown sweep settings: " + ", ".join(sorted(unknown)))
+    full = dict(DEFAULT_CONFIG)
+    full.update(config)
+    return json.loads(json.dumps(full, sort_keys=True, default=_to_json))
+
+
+def config_key(config):
+    """
+    returns the database key of a configuration
+    """
+    text = json.dumps(normalize_config(config), sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def expand_grid(grid, base=None):
+    """
+    returns the configurations of every combination of the grid values
+    ARGS:
+    grid: dict - setting name to a list of the values it takes, e.g.
+                 {"diversity": [10, 30], "pert_value": [[125], list(range(125, 150))]}
+    base: dict - settings shared by all configurations
+    """
+    names = sorted(grid)
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        config = dict(base or {})
+        config.update(zip(names, values))
+        configs.append(config)
+    return configs
+
+
+def _to_blob(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array))
+    return buffer.getvalue()
+
+
+def _from_blob(blob):
+    return np.load(io.BytesIO(blob))
+
+
+class SweepStore:
+    def __init__(self, path):
+        """
+        Open or create the sweep database at path. Each process running
+        configurations opens its own SweepStore on the same file.
+        """
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, config TEXT, status TEXT, "
+            "started REAL, finished REAL, best_fitness REAL, discrete_genome BLOB, "
+            "continuous_genome BLOB, error TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS generations (key TEXT, generation INTEGER, "
+            "best_fitness REAL, mean_fitness REAL, PRIMARY KEY (key, generation))"
+        )
+        self.db.commit()
+
+    def completed(self):
+        """
+        returns the set of keys of completed runs
+        """
+        return {row[0] for row in self.db.execute("SELECT key FROM runs WHERE status = 'done'")}
+
+    def start(self, key, config):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO runs (key, config, status, started) VALUES (?, ?, 'running', ?)",
+                (key, json.dumps(config, sort_keys=True), time.time()),
+            )
+
+    def record_generation(self, key, generation, best_fitness, mean_fitness):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)",
+                (key, generation, float(best_fitness), float(mean_fitness)),
+            )
+
+    def discard_generations(self, key, after):
+        """
+        drop the curve points of key after generation after, e.g. those
+        recorded after the checkpoint a run resumes from
+        """
+        with self.db:
+            self.db.execute("DELETE FROM generations WHERE key = ? AND generation > ?", (key, after))
+
+    def finish(self, key, best_fitness, discrete_genome, continuous_genome):
+        with self.db:
+            self.db.execute(
+                "UPDATE runs SET status = 'done', finished = ?, best_fitness = ?, discrete_genome = ?, "
+                "continuous_genome = ?, error = NULL WHERE key = ?",
+                (time.time(), float(best_fitness), _to_blob(discrete_genome), _to_blob(continuous_genome), key),
+            )
+
+    def fail(self, key, error):
+        with self.db:
+            self.db.execute(
+                "UPDATE runs SET status = 'failed', finished = ?, error = ? WHERE key = ?",
+                (time.time(), error, key),
+            )
+
+    def curves(self, key):
+        """
+        returns the best and mean fitness of each generation of a run
+        """
+        rows = self.db.execute(
+            "SELECT best_fitness, mean_fitness FROM generations WHERE key = ? ORDER BY generation", (key,)
+        ).fetchall()
+        rows = np.asarray(rows, dtype=float).reshape(-1, 2)
+        return rows[:, 0], rows[:, 1]
+
+    def results(self):
+        """
+        returns a dict per completed run with its key, config, best_fitness,
+        best and mean fitness curves and final best genome
+        """
+        results = []
+        for key, config, best_fitness, discrete_genome, continuous_genome in self.db.execute(
+            "SELECT key, config, best_fitness, discrete_genome, continuous_genome FROM runs "
+            "WHERE status = 'done' ORDER BY finished"
+        ).fetchall():
+            best_curve, mean_curve = self.curves(key)
+            results.append({
+                "key": key,
+                "config": json.loads(config),
+                "best_fitness": best_fitness,
+                "best_curve": best_curve,
+                "mean_curve": mean_curve,
+                "discrete_genome": _from_blob(discrete_genome),
+                "continuous_genome": _from_blob(continuous_genome),
+            })
+        return results
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def make_evol_params(config):
+    """
+    returns the EvolSearch parameters of a normalized configuration, as set
+    up in evolution_example.py. Draws the flux noise from the global RNG.
+    """
+    diversity = config["diversity"]
+    fluxes = np.arange(config["flux_start"], config["flux_stop"], config["flux_step"])
+    num_scenarios = config["num_scenarios"]
+    if num_scenarios > 1:
+        fluxes = fluxes + config["noise"] * (-0.5 + np.random.sample((num_scenarios, len(fluxes))))
+    elif config["noise"]:
+        fluxes = fluxes + config["noise"] * (-0.5 + np.random.sample(len(fluxes)))
+    forcing = ForcingSchedule(fluxes, config["pert_value"], config["perturbation"])
+
+    keywords = dict(diversity=diversity, maxconv=config["maxconv"], fluxes=forcing)
+    if num_scenarios > 1:
+        fitness_function = partial(daisyworld_fitness_ensemble, **keywords)
+        batch_fitness_function = partial(daisyworld_fitness_ensemble_batch, **keywords)
+    else:
+        fitness_function = partial(daisyworld_fitness_vectorized, display=False, **keywords)
+        batch_fitness_function = partial(daisyworld_fitness_batch, **keywords)
+
+    return {
+        "num_processes": 1,
+        "pop_size": config["pop_size"],
+        "continuous_genotype_size": diversity,
+        "discrete_genotype_size": diversity * diversity,
+        "fitness_function": fitness_function,
+        "batch_fitness_function": batch_fitness_function,
+        "canonicalize_function": partial(canonical_genotype, diversity=diversity),
+        "elitist_fraction": config["elitist_fraction"],
+        "discrete_mutation_probability": config["discrete_mutation_probability"],
+        "continuous_mutation_variance": config["continuous_mutation_variance"],
+        "validate_fitness_function": False,
+    }
+
+
+def run_config(config, path, checkpoint_dir=None):
+    """
+    run one configuration and store it in the sweep database at path,
+    returns its key. With checkpoint_dir the run is checkpointed every
+    generation and continues from its checkpoint if one exists.
+    """
+    config = normalize_config(config)
+    key = config_key(config)
+    store = SweepStore(path)
+    evolution = None
+    try:
+        store.start(key, config)
+        np.random.seed(config["seed"])
+        evol_params = make_evol_params(config)
+        pop_size = config["pop_size"]
+        discrete_initial_pop = np.random.randint(2, size=(pop_size, evol_params["discrete_genotype_size"]))
+        continuous_initial_pop = np.random.uniform(0, 1, size=(pop_size, evol_params["continuous_genotype_size"]))
+        evolution = EvolSearch(evol_params, discrete_initial_pop, continuous_initial_pop)
+
+        checkpoint_path = None
+        if checkpoint_dir:
+            checkpoint_path = os.path.join(checkpoint_dir, key + ".npz")
+            if os.path.exists(checkpoint_path):
+                evolution.load_checkpoint(checkpoint_path)
+        store.discard_generations(key, evolution.generation)
+
+        while evolution.generation < config["num_gens"]:
+            evolution.step_generation()
+            store.record_generation(
+                key, evolution.generation, evolution.get_best_individual_fitness(), evolution.get_mean_fitness()
+            )
+            if checkpoint_path:
+                evolution.save_checkpoint(checkpoint_path)
+
+        discrete_genome, continuous_genome = evolution.get_best_individual()
+        store.finish(key, evolution.get_best_individual_fitness(), discrete_genome, continuous_genome)
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    except Exception as e:
+        store.fail(key, repr(e))
+    finally:
+        if evolution is not None:
+            evolution.close()
+        store.close()
+    return key
+
+
+def run_sweep(configs, path, num_processes=None, checkpoint_dir=None):
+    """
+    run every configuration not yet completed in the sweep database at path
+    ARGS:
+    configs: list of dict - configurations, see DEFAULT_CONFIG and expand_grid
+    path: str - SQLite file holding the results
+    num_processes: int - runs done in parallel, defaults to os.cpu_count(). 1 runs them in this process
+    checkpoint_dir: str - directory for per-run checkpoints, lets interrupted runs resume mid-run
+    returns the keys of the configurations run, in completion order
+    """
+    store = SweepStore(path)
+    completed = store.completed()
+    store.close()
+
+    # equal configurations are run once
+    pending = {}
+    for config in configs:
+        config = normalize_config(config)
+        key = config_key(config)
+        if key not in completed:
+            pending[key] = config
+    if not pending:
+        return []
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    run = partial(run_config, path=path, checkpoint_dir=checkpoint_dir)
+    if num_processes == 1:
+        return [run(config) for config in pending.values()]
+
+    pool = ProcessPool(num_processes)
+    try:
+        return list(pool.uimap(run, list(pending.values())))
+    finally:
+        pool.close()
+        pool.join()
+        pool.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sweep", help='JSON file with {"grid": ..., "base": ...} or a list of configurations')
+    parser.add_argument("--db", default="sweep.db", help="SQLite file holding the results")
+    parser.add_argument("--processes", type=int, default=None, help="runs done in parallel")
+    parser.add_argument("--checkpoints", default=None, help="directory for per-run checkpoints")
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep = json.load(f)
+    if isinstance(sweep, dict):
+        configs = expand_grid(sweep["grid"], sweep.get("base"))
+    else:
+        configs = sweep
+
+    start = time.perf_counter()
+    keys = run_sweep(configs, args.db, args.processes, args.checkpoints)
+    print("%d of %d configurations run in %.1f s" % (len(keys), len(configs), time.perf_counter() - start))
+
+    store = SweepStore(args.db)
+    for key in keys:
+        row = store.db.execute("SELECT status, best_fitness, error FROM runs WHERE key = ?", (key,)).fetchone()
+        print(key, *row)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Append-only, memory-mapped store of daisyworld trajectories
+
+Every state yielded by EvoDaisy.daisyworld_trajectory becomes one record of
+a structured array, tagged with the index of the genome it belongs to.
+Records are appended to a .npy file whose header is rewritten in place on
+flush, so the file can be opened with np.load(path, mmap_mode="r") or
+read_trajectories and analysed without loading it into memory. Records
+written after the last flush are still recovered by read_trajectories from
+the file size.
+"""
+import os
+
+import numpy as np
+
+# bytes reserved for the .npy header, the record count is rewritten in place
+HEADER_SIZE = 1024
+
+
+def trajectory_dtype(diversity):
+    """
+    returns the record dtype of trajectories with diversity species
+    """
+    return np.dtype([
+        ("genome", "<i8"),
+        ("step", "<i4"),
+        ("flux", "<f8"),
+        ("area", "<f8", (diversity,)),
+        ("area_barren", "<f8"),
+        ("Tp", "<f8"),
+        ("Tp_dead", "<f8"),
+        ("iterations", "<i4"),
+        ("converged", "?"),
+        ("init_life", "<f8"),
+        ("end_life", "<f8"),
+    ])
+
+
+def _header(dtype, num_records):
+    """
+    returns a version 1.0 .npy header of exactly HEADER_SIZE bytes
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype), num_records
+    )
+    prefix = np.lib.format.MAGIC_PREFIX + bytes([1, 0])
+    padding = HEADER_SIZE - len(prefix) - 2 - len(header) - 1
+    if padding < 0:
+        raise Exception("Trajectory record dtype is too large for the .npy header")
+    header = header + " " * padding + "\n"
+    return prefix + np.uint16(len(header)).tobytes() + header.encode("latin1")
+
+
+def _read_dtype(path):
+    with open(path, "rb") as f:
+        np.lib.format.read_magic(f)
+        _, _, dtype = np.lib.format.read_array_header_1_0(f)
+        if f.tell() != HEADER_SIZE:
+            raise Exception(path + " is not a trajectory file")
+    return dtype
+
+
+def read_trajectories(path):
+    """
+    returns a read-only memory map of all records in the file at path
+    """
+    dtype = _read_dtype(path)
+    num_records = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if num_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(num_records,))
+
+
+def genome_trajectory(records, genome):
+    """
+    returns the records of one genome, in flux step order
+    """
+    return records[records["genome"] == genome]
+
+
+class TrajectoryRecorder:
+    def __init__(self, path, diversity):
+        """
+        Open the trajectory file at path for appending, creating it if needed
+        ARGS:
+        path: str - .npy file holding the records
+        diversity: int - number of species, must match an existing file
+        """
+        self.path = path
+        self.dtype = trajectory_dtype(diversity)
+
+        if os.path.exists(path):
+            if _read_dtype(path) != self.dtype:
+                raise Exception(path + " holds trajectories of a different diversity")
+            records = read_trajectories(path)
+            self.num_records = len(records)
+            self.num_genomes = int(records["genome"].max()) + 1 if len(records) else 0
+            del records
+            self.file = open(path, "r+b")
+            # drop a partly written record at the end
+            self.file.truncate(HEADER_SIZE + self.num_records * self.dtype.itemsize)
+        else:
+            self.num_records = 0
+            self.num_genomes = 0
+            self.file = open(path, "w+b")
+            self.file.write(_header(self.dtype, 0))
+        self.file.seek(0, os.SEEK_END)
+
+    def record(self, trajectory):
+        """
+        append the states of a trajectory (an iterable of the dicts yielded by
+        daisyworld_trajectory) as a new genome and return its genome index
+        """
+        states = list(trajectory)
+        records = np.zeros(len(states), dtype=self.dtype)
+        genome = self.num_genomes
+        records["genome"] = genome
+        for i, state in enumerate(states):
+            for name in self.dtype.names[1:]:
+                records[name][i] = state[name]
+
+        self.file.write(records.tobytes())
+        self.num_records += len(records)
+        self.num_genomes += 1
+        return genome
+
+    def flush(self):
+        """
+        write the record count into the header and flush the file
+        """
+        self.file.seek(0)
+        self.file.write(_header(self.dtype, self.num_records))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
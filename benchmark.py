@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the daisyworld simulation and the evolutionary search
+
+Runs offline and writes the timings as JSON so results can be compared
+across commits:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+
+With --compare every benchmark also present in the earlier file is listed
+with its time ratio, and the script exits with status 1 if any of them got
+slower by more than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import warnings
+from functools import partial
+
+import numpy as np
+
+warnings.filterwarnings("ignore")
+
+from EvoDaisy import ForcingSchedule, daisyworld_fitness, daisyworld_fitness_batch
+from EvolSearch_mixed import EvolSearch
+
+
+def time_call(function, repeats):
+    """
+    returns the best wall time of repeats calls of function
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def make_fluxes():
+    """
+    the noisy flux schedule of evolution_example.py with a fixed seed
+    """
+    rng = np.random.RandomState(0)
+    fluxes = np.arange(0, 3.0, 0.02)
+    return fluxes + (-0.5 + rng.random_sample(len(fluxes))) / 10
+
+
+def bench_simulation(quick):
+    """
+    single genome simulation across diversity levels, maxconv values and
+    backends, and on a large sparse food web
+    """
+    fluxes = make_fluxes()
+    rng = np.random.RandomState(1)
+    results = []
+    for diversity in (10, 30, 100):
+        food_web = rng.randint(2, size=diversity * diversity)
+        albedos = rng.uniform(0, 1, diversity)
+        for maxconv in ((10, 100) if not quick else (10,)):
+            backends = ["numpy", "jit"]
+            # the reference loop takes minutes at high diversity
+            if diversity <= 30 and maxconv <= 10:
+                backends.insert(0, "python")
+            for backend in backends:
+                function = partial(
+                    daisyworld_fitness, food_web, albedos, diversity, maxconv, False,
+                    fluxes, list(range(125, 150)), -1.0, backend=backend,
+                )
+                # first call compiles the jit kernel
+                function()
+                results.append({
+                    "name": "simulation/%s/diversity=%d/maxconv=%d" % (backend, diversity, maxconv),
+                    "seconds": time_call(function, 1 if quick else 3),
+                })
+
+    # large sparse food webs, picked up by the sparse interaction terms
+    diversity = 300
+    food_web = (rng.uniform(0, 1, diversity * diversity) < 0.02).astype(int)
+    albedos = rng.uniform(0, 1, diversity)
+    for backend in ("numpy", "jit"):
+        function = partial(
+            daisyworld_fitness, food_web, albedos, diversity, 10, False,
+            fluxes, list(range(125, 150)), -1.0, backend=backend,
+        )
+        function()
+        results.append({
+            "name": "simulation/%s/sparse/diversity=%d/maxconv=10" % (backend, diversity),
+            "seconds": time_call(function, 1 if quick else 3),
+        })
+    return results
+
+
+def executor_label(evolution):
+    """
+    the executor that actually ran, make_executor caps num_processes at os.cpu_count()
+    """
+    return "%s/workers=%d" % (evolution.executor.name, evolution.executor.num_workers)
+
+
+def make_evol_params(pop_size, diversity, maxconv, num_processes, batch):
+    forcing = ForcingSchedule(make_fluxes(), list(range(125, 150)), -1.0)
+    keywords = dict(diversity=diversity, maxconv=maxconv, fluxes=forcing)
+    evol_params = {
+        "num_processes": num_processes,
+        "pop_size": pop_size,
+        "continuous_genotype_size": diversity,
+        "discrete_genotype_size": diversity * diversity,
+        "fitness_function": partial(daisyworld_fitness, display=False, backend="numpy", **keywords),
+        "elitist_fraction": 0.1,
+        "discrete_mutation_probability": 0.1,
+        "continuous_mutation_variance": 0.1,
+    }
+    if batch:
+        evol_params["batch_fitness_function"] = partial(daisyworld_fitness_batch, **keywords)
+    return evol_params
+
+
+def bench_generation(quick):
+    """
+    one full step_generation at several population sizes and pool sizes
+    """
+    diversity = 10
+    maxconv = 10
+    rng = np.random.RandomState(2)
+    results = []
+    for pop_size in ((50, 200) if not quick else (50,)):
+        configs = [(n, False) for n in sorted({1, 4, os.cpu_count()})] + [(1, True)]
+        labels = set()
+        for num_processes, batch in configs:
+            evol_params = make_evol_params(pop_size, diversity, maxconv, num_processes, batch)
+            evolution = EvolSearch(
+                evol_params,
+                rng.randint(2, size=(pop_size, diversity * diversity)),
+                rng.uniform(0, 1, size=(pop_size, diversity)),
+            )
+            mode = "batch" if batch else executor_label(evolution)
+            if mode in labels:
+                # pool sizes capped to the same executor on this machine
+                evolution.close()
+                continue
+            labels.add(mode)
+            # the first generation evaluates the initial population
+            evolution.step_generation()
+            results.append({
+                "name": "step_generation/%s/pop_size=%d" % (mode, pop_size),
+                "seconds": time_call(evolution.step_generation, 1 if quick else 3),
+            })
+            evolution.close()
+    return results
+
+
+def bench_operators(quick):
+    """
+    elitist_selection and mutation alone, with a trivial fitness function, on
+    plain and bit-packed discrete populations
+    """
+    diversity = 30
+    rng = np.random.RandomState(3)
+    results = []
+    pop_sizes = (200, 10000, 100000) if not quick else (200, 10000)
+    for pop_size, packed in [(n, packed) for n in pop_sizes for packed in (False, True)]:
+        evol_params = {
+            "pop_size": pop_size,
+            "continuous_genotype_size": diversity,
+            "discrete_genotype_size": diversity * diversity,
+            "fitness_function": lambda discrete, continuous: float(np.sum(continuous)),
+            "batch_fitness_function": lambda discrete_pop, continuous_pop: np.sum(continuous_pop, axis=1),
+            "num_processes": 1,
+            "elitist_fraction": 0.1,
+            "discrete_mutation_probability": 0.1,
+            "continuous_mutation_variance": 0.1,
+            "packed_discrete": packed,
+        }
+        evolution = EvolSearch(
+            evol_params,
+            rng.randint(2, size=(pop_size, diversity * diversity)),
+            rng.uniform(0, 1, size=(pop_size, diversity)),
+        )
+        fitness = rng.uniform(0, 1, pop_size)
+        discrete_pop = evolution.discrete_pop
+        continuous_pop = evolution.continuous_pop
+
+        def select():
+            evolution.discrete_pop = discrete_pop
+            evolution.continuous_pop = continuous_pop
+            evolution.fitness = fitness
+            evolution.elitist_selection()
+
+        select()
+        elite_discrete_pop = evolution.discrete_pop
+        elite_continuous_pop = evolution.continuous_pop
+
+        def mutate():
+            evolution.discrete_pop = elite_discrete_pop
+            evolution.continuous_pop = elite_continuous_pop
+            evolution.mutation()
+
+        repeats = 1 if quick else 3
+        layout = "packed/" if packed else ""
+        results.append({
+            "name": "operators/elitist_selection/%spop_size=%d" % (layout, pop_size),
+            "seconds": time_call(select, repeats),
+        })
+        results.append({
+            "name": "operators/mutation/%spop_size=%d" % (layout, pop_size),
+            "seconds": time_call(mutate, repeats),
+        })
+    return results
+
+
+def import_time(module, repeats):
+    """
+    best wall time of importing module in a fresh interpreter, as paid by
+    every worker process
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", "import " + module], cwd=cwd)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_startup(quick):
+    """
+    module import in a fresh interpreter and EvolSearch construction up to
+    ready workers, the fixed cost of every short job
+    """
+    repeats = 1 if quick else 3
+    results = []
+    for module in ("numpy", "EvoDaisy", "EvolSearch_mixed"):
+        results.append({"name": "startup/import/%s" % module, "seconds": import_time(module, repeats)})
+
+    diversity = 10
+    pop_size = 50
+    rng = np.random.RandomState(4)
+    labels = set()
+    for num_processes in sorted({1, 4}):
+        evol_params = make_evol_params(pop_size, diversity, 10, num_processes, False)
+        evol_params["validate_fitness_function"] = False
+        start = time.perf_counter()
+        evolution = EvolSearch(
+            evol_params,
+            rng.randint(2, size=(pop_size, diversity * diversity)),
+            rng.uniform(0, 1, size=(pop_size, diversity)),
+        )
+        elapsed = time.perf_counter() - start
+        label = executor_label(evolution)
+        if label not in labels:
+            labels.add(label)
+            results.append({"name": "startup/evolsearch/%s" % label, "seconds": elapsed})
+            results.append({"name": "startup/pool_warm_up/%s" % label, "seconds": evolution.pool_startup_time})
+        evolution.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """
+    print time ratios against an earlier benchmark file, returns True if any
+    benchmark got slower by more than threshold
+    """
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r["seconds"] for r in json.load(f)["results"]}
+
+    regressed = False
+    for r in results:
+        if r["name"] not in baseline:
+            continue
+        ratio = r["seconds"] / baseline[r["name"]]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print("%-60s %8.3fx%s" % (r["name"], ratio, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="bench.json", help="JSON file to write the results to")
+    parser.add_argument("--quick", action="store_true", help="fewer sizes and a single repeat")
+    parser.add_argument("--only", choices=["startup", "simulation", "generation", "operators"], action="append",
+                        help="run only the given group, may be repeated")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported as a regression by --compare")
+    args = parser.parse_args()
+
+    groups = {
+        "startup": bench_startup,
+        "simulation": bench_simulation,
+        "generation": bench_generation,
+        "operators": bench_operators,
+    }
+    results = []
+    for name, bench in groups.items():
+        if args.only and name not in args.only:
+            continue
+        for r in bench(args.quick):
+            print("%-60s %10.4f s" % (r["name"], r["seconds"]))
+            results.append(r)
+
+    output = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "quick": args.quick,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from tkinter import W
+import os
 import numpy as np
 import pickle
 # WARNING I AM FILTERING WARNINGS BECUASE PATHOS DOESN'T LIKE THEM
@@ -8,12 +8,17 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from EvolSearch_mixed import EvolSearch
-from EvoDaisy import daisyworld_fitness
+from EvoDaisy import daisyworld_fitness_vectorized, daisyworld_fitness_batch, canonical_genotype
+from EvoDaisy import daisyworld_fitness_ensemble, daisyworld_fitness_ensemble_batch, noise_scenarios
+from EvoDaisy import ForcingSchedule
 from functools import partial
 
 
 use_best_individual = False
-if use_best_individual:
+# continue a killed run from its last checkpoint
+resume = False
+checkpoint_path = "checkpoint.npz"
+if use_best_individual or resume:
     with open("best_individual", "rb") as f:
         best_individual = pickle.load(f)
 
@@ -40,11 +45,20 @@ pert_value = list(range(125,150))
 
 ## Noise
 add_noise = True
+# score genomes by their mean duration over num_scenarios noise draws
+# instead of a single noisy schedule
+ensemble = False
+num_scenarios = 8
 
 if add_noise == True:
-    noise = (-0.5 + np.random.sample(len(fluxes)))/10
-    fluxes = fluxes + noise
+    if ensemble:
+        fluxes = noise_scenarios(fluxes, num_scenarios)
+    else:
+        noise = (-0.5 + np.random.sample(len(fluxes)))/10
+        fluxes = fluxes + noise
 
+# perturbed fluxes and per-step constants, computed once and shared by every genome
+forcing = ForcingSchedule(fluxes, pert_value, perturbation)
 
 ########################
 # Evolve Solutions
@@ -54,14 +68,25 @@ pop_size = 200
 discrete_genotype_size = diversity * diversity
 continuous_genotype_size = diversity
 
+if ensemble:
+    fitness_function = partial(daisyworld_fitness_ensemble, diversity=diversity, maxconv=maxconv, fluxes=forcing)
+    batch_fitness_function = partial(daisyworld_fitness_ensemble_batch, diversity=diversity, maxconv=maxconv,
+                                     fluxes=forcing,
+                                     return_scenarios=True)  # per-scenario durations go to evolution.scenario_fitness
+else:
+    fitness_function = partial(daisyworld_fitness_vectorized, diversity=diversity, display=display, 
+                               maxconv=maxconv, fluxes=forcing)
+    batch_fitness_function = partial(daisyworld_fitness_batch, diversity=diversity,
+                                     maxconv=maxconv, fluxes=forcing)
+
 evol_params = {
     "num_processes": 100,
     "pop_size": pop_size,  # population size
     "continuous_genotype_size": continuous_genotype_size,  # dimensionality of solution
     "discrete_genotype_size": discrete_genotype_size,
-    "fitness_function": partial(daisyworld_fitness, diversity=diversity, display=display, 
-                                maxconv=maxconv, fluxes=fluxes, pert_value=pert_value,
-                                perturbation=perturbation),  # custom function defined to evaluate fitness of a solution
+    "fitness_function": fitness_function,  # custom function defined to evaluate fitness of a solution
+    "batch_fitness_function": batch_fitness_function,  # evaluates the whole population in one call
+    "canonicalize_function": partial(canonical_genotype, diversity=diversity),  # simulate equivalent genomes once
     "elitist_fraction": 0.1,  # fraction of population retained as is between generation
     "discrete_mutation_probability": 0.1, # probability of mutation of the discrete genome
     "continuous_mutation_variance": 0.1,  # mutation noise added to offspring.
@@ -83,7 +108,13 @@ save_best_individual = {
     "mean_fitness": [],
 }
 
-for i in range(20):
+if resume and os.path.exists(checkpoint_path):
+    evolution.load_checkpoint(checkpoint_path)
+    save_best_individual = best_individual
+    save_best_individual["best_fitness"] = save_best_individual["best_fitness"][: evolution.generation]
+    save_best_individual["mean_fitness"] = save_best_individual["mean_fitness"][: evolution.generation]
+
+for i in range(evolution.generation, 20):
     evolution.step_generation()
     
     save_best_individual["discrete_params"], save_best_individual["continuous_params"] = evolution.get_best_individual()
@@ -94,8 +125,13 @@ for i in range(20):
     print(
         len(save_best_individual["best_fitness"]), 
         save_best_individual["best_fitness"][-1], 
-        save_best_individual["mean_fitness"][-1]
+        save_best_individual["mean_fitness"][-1],
+        evolution.num_deduplicated
     )
 
     with open("best_individual", "wb") as f:
-        pickle.dump(save_best_individual, f)
\ No newline at end of file
+        pickle.dump(save_best_individual, f)
+
+    evolution.save_checkpoint(checkpoint_path, background=True)
+
+evolution.close()
\ No newline at end of file
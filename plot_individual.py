@@ -1,11 +1,45 @@
+import os
 import pickle
 import numpy as np
-from EvoDaisy import daisyworld_fitness
+from DaisyPlot import plot_trajectory
+from EvoDaisy import daisyworld_trajectory
+from TrajectoryRecorder import TrajectoryRecorder, read_trajectories, genome_trajectory
+
+# trajectories are simulated once and then plotted from this file
+trajectory_path = "trajectories.npy"
+# the genome of the last recorded trajectory and its genome index in trajectory_path
+recorded_genome_path = "trajectories_genome.npz"
 
 with open("best_individual", "rb") as f:
     best_individual = pickle.load(f)
-    
-daisyworld_fitness(best_individual["discrete_params"], best_individual["continuous_params"], diversity=30, display=True, maxconv=100, fluxes=np.arange(0.5, 3.0, 0.02), pert_value=[0], perturbation=0)
+
+diversity = best_individual.get("diversity", 30)
+maxconv = best_individual.get("maxconv", 100)
+
+# reuse the last recorded trajectory while it is still of the current best individual
+genome = None
+if os.path.exists(trajectory_path) and os.path.exists(recorded_genome_path):
+    with np.load(recorded_genome_path) as recorded:
+        if (np.array_equal(recorded["discrete_params"], best_individual["discrete_params"])
+                and np.array_equal(recorded["continuous_params"], best_individual["continuous_params"])):
+            genome = int(recorded["genome"])
+
+if genome is None:
+    with TrajectoryRecorder(trajectory_path, diversity) as recorder:
+        genome = recorder.record(daisyworld_trajectory(
+            best_individual["discrete_params"], best_individual["continuous_params"], diversity=diversity,
+            maxconv=maxconv, fluxes=np.arange(0.5, 3.0, 0.02), pert_value=[0], perturbation=0,
+        ))
+    np.savez(
+        recorded_genome_path,
+        genome=genome,
+        discrete_params=best_individual["discrete_params"],
+        continuous_params=best_individual["continuous_params"],
+    )
+
+records = read_trajectories(trajectory_path)
+trajectory = genome_trajectory(records, genome)
+plot_trajectory(trajectory)
 
 print(best_individual["discrete_params"])
-print(best_individual["continuous_params"]) 
\ No newline at end of file
+print(best_individual["continuous_params"])
@@ -0,0 +1,114 @@
+"""
+Distributed evaluation on localhost workers, compared with local evaluation
+"""
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from DistributedEval import Coordinator, start_local_workers
+from EvoDaisy import ForcingSchedule, daisyworld_fitness
+from EvolSearch_mixed import EvolSearch
+
+AUTHKEY = b"daisyworld-test"
+DIVERSITY = 4
+MAXCONV = 10
+POP_SIZE = 8
+# seconds a slow evaluation takes, and the heartbeats of the workers evaluating it
+SLOW_TIME = 0.3
+HEARTBEAT_INTERVAL = 0.1
+HEARTBEAT_TIMEOUT = 1.0
+
+
+def _forcing():
+    fluxes = np.arange(0, 3.0, 0.1)
+    fluxes = fluxes + (-0.5 + np.random.RandomState(1).random_sample(len(fluxes))) / 10
+    return ForcingSchedule(fluxes, list(range(20, 25)), -1.0)
+
+
+def _daisyworld(food_web, albedos, maxconv=MAXCONV):
+    return daisyworld_fitness(food_web, albedos, DIVERSITY, maxconv, False, _forcing(), backend="numpy")
+
+
+def _slow_fitness(discrete_genotype, continuous_genotype):
+    time.sleep(SLOW_TIME)
+    return float(np.sum(discrete_genotype) + np.sum(continuous_genotype))
+
+
+def _population():
+    rng = np.random.RandomState(0)
+    return rng.randint(2, size=(POP_SIZE, DIVERSITY * DIVERSITY)), rng.uniform(0, 1, size=(POP_SIZE, DIVERSITY))
+
+
+def _wait_for_workers(coordinator, num_workers, timeout=30.0):
+    deadline = time.time() + timeout
+    while coordinator.num_workers < num_workers:
+        assert time.time() < deadline, "workers did not connect"
+        time.sleep(0.05)
+
+
+def _stop_workers(workers):
+    for worker in workers:
+        if worker.is_alive():
+            worker.kill()
+        worker.join()
+
+
+@pytest.mark.parametrize("packed_discrete", [False, True])
+def test_coordinator_matches_local_evaluation(packed_discrete):
+    discrete_pop, continuous_pop = _population()
+    evol_params = {
+        "pop_size": POP_SIZE,
+        "fitness_function": _daisyworld,
+        "fitness_args": [2 * MAXCONV],
+        "elitist_fraction": 0.25,
+        "discrete_genotype_size": DIVERSITY * DIVERSITY,
+        "continuous_genotype_size": DIVERSITY,
+        "discrete_mutation_probability": 0.1,
+        "continuous_mutation_variance": 0.1,
+        "packed_discrete": packed_discrete,
+        "distributed_address": ("localhost", 0),
+        "distributed_authkey": AUTHKEY,
+        "seed": 0,
+    }
+    search = EvolSearch(evol_params, discrete_pop, continuous_pop)
+    workers = start_local_workers(search.coordinator.address, AUTHKEY, 2, HEARTBEAT_INTERVAL)
+    try:
+        indices = np.arange(POP_SIZE)
+        remote = search.evaluate_population(indices)
+        local = [search.evaluate_fitness(i) for i in indices]
+        np.testing.assert_allclose(remote, local)
+    finally:
+        search.close()
+        _stop_workers(workers)
+
+
+@pytest.mark.parametrize("lost", ["killed", "stopped"])
+def test_lost_worker_batch_is_reassigned(lost):
+    # a killed worker disconnects, a stopped one goes silent until its heartbeats time out
+    discrete_pop, continuous_pop = _population()
+    coordinator = Coordinator(("localhost", 0), AUTHKEY, heartbeat_timeout=HEARTBEAT_TIMEOUT)
+    coordinator.set_function(_slow_fitness)
+    workers = start_local_workers(coordinator.address, AUTHKEY, 2, HEARTBEAT_INTERVAL)
+    try:
+        _wait_for_workers(coordinator, 2)
+        victim = workers[0]
+        if lost == "killed":
+            interrupt = threading.Timer(SLOW_TIME / 2, victim.kill)
+        else:
+            interrupt = threading.Timer(SLOW_TIME / 2, os.kill, (victim.pid, signal.SIGSTOP))
+        interrupt.start()
+        indices = np.arange(POP_SIZE)
+        fitness, aborted = coordinator.evaluate(discrete_pop, continuous_pop, indices)
+        interrupt.join()
+
+        expected = [_slow_fitness(discrete_pop[i], continuous_pop[i]) for i in indices]
+        np.testing.assert_allclose(fitness, expected)
+        assert not np.any(aborted)
+        assert coordinator.num_reassigned >= 1
+    finally:
+        coordinator.close()
+        _stop_workers(workers)
@@ -0,0 +1,114 @@
+"""
+Parity of the daisyworld_fitness backends with the reference Species loop
+"""
+import numpy as np
+import pytest
+
+from EvoDaisy import ForcingSchedule, daisyworld_fitness, daisyworld_fitness_batch, daisyworld_fitness_vectorized
+
+DIVERSITY = 6
+MAXCONV = 20
+NUM_GENOMES = 6
+# a threshold inside the range of the durations, and one high enough that every sweep aborts
+THRESHOLDS = [0.8, 2.5]
+
+
+@pytest.fixture(scope="module")
+def forcing():
+    fluxes = np.arange(0, 3.0, 0.05)
+    fluxes = fluxes + (-0.5 + np.random.RandomState(1).random_sample(len(fluxes))) / 10
+    return ForcingSchedule(fluxes, list(range(40, 45)), -1.0)
+
+
+@pytest.fixture(scope="module")
+def population():
+    rng = np.random.RandomState(0)
+    discrete_pop = rng.randint(2, size=(NUM_GENOMES, DIVERSITY * DIVERSITY))
+    continuous_pop = rng.uniform(0, 1, size=(NUM_GENOMES, DIVERSITY))
+    return discrete_pop, continuous_pop
+
+
+@pytest.fixture(scope="module")
+def reference(forcing, population):
+    discrete_pop, continuous_pop = population
+    return np.array([
+        daisyworld_fitness(discrete_pop[i], continuous_pop[i], DIVERSITY, MAXCONV, False, forcing, backend="python")
+        for i in range(NUM_GENOMES)
+    ])
+
+
+@pytest.mark.parametrize("backend", ["numpy", "jit"])
+def test_backend_matches_reference(backend, forcing, population, reference):
+    discrete_pop, continuous_pop = population
+    durations = [
+        daisyworld_fitness(discrete_pop[i], continuous_pop[i], DIVERSITY, MAXCONV, False, forcing, backend=backend)
+        for i in range(NUM_GENOMES)
+    ]
+    np.testing.assert_allclose(durations, reference)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_batch_matches_reference(sparse, forcing, population, reference):
+    discrete_pop, continuous_pop = population
+    durations = daisyworld_fitness_batch(discrete_pop, continuous_pop, DIVERSITY, MAXCONV, forcing, sparse=sparse)
+    np.testing.assert_allclose(durations, reference)
+
+
+def test_genome_is_not_modified(forcing, population):
+    discrete_pop, continuous_pop = population
+    food_web = discrete_pop[0].copy()
+    for backend in ("python", "numpy", "jit"):
+        daisyworld_fitness(food_web, continuous_pop[0], DIVERSITY, MAXCONV, False, forcing, backend=backend)
+        np.testing.assert_array_equal(food_web, discrete_pop[0])
+
+
+def _check_threshold(values, aborted, reference, threshold):
+    values = np.asarray(values)
+    aborted = np.asarray(aborted, dtype=bool)
+    if threshold > reference.max() + 1:
+        assert np.all(aborted)
+    # complete sweeps are exact, aborted ones are lower bounds below the threshold
+    np.testing.assert_allclose(values[~aborted], reference[~aborted])
+    assert np.all(values[aborted] < threshold)
+    assert np.all(values[aborted] <= reference[aborted] + 1e-9)
+    # an individual that reaches the threshold is never aborted
+    assert not np.any(aborted & (reference >= threshold))
+
+
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+@pytest.mark.parametrize("backend", ["python", "numpy", "jit"])
+def test_threshold_matches_reference(backend, threshold, forcing, population, reference):
+    discrete_pop, continuous_pop = population
+    results = [
+        daisyworld_fitness(discrete_pop[i], continuous_pop[i], DIVERSITY, MAXCONV, False, forcing,
+                           backend=backend, threshold=threshold)
+        for i in range(NUM_GENOMES)
+    ]
+    values, aborted = zip(*results)
+    _check_threshold(values, aborted, reference, threshold)
+
+
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+@pytest.mark.parametrize("sparse", [False, True])
+def test_batch_threshold_matches_reference(sparse, threshold, forcing, population, reference):
+    discrete_pop, continuous_pop = population
+    values, aborted = daisyworld_fitness_batch(
+        discrete_pop, continuous_pop, DIVERSITY, MAXCONV, forcing, sparse=sparse, threshold=threshold
+    )
+    _check_threshold(values, aborted, reference, threshold)
+
+
+def test_newton_matches_converged_fixed_step(forcing, population):
+    # the first flux of the noisy schedule is negative, where the planet temperature is NaN
+    assert forcing.fluxes[0, 0] < 0
+    discrete_pop, continuous_pop = population
+    converged = daisyworld_fitness_batch(discrete_pop, continuous_pop, DIVERSITY, 100 * MAXCONV, forcing)
+    newton = daisyworld_fitness_batch(discrete_pop, continuous_pop, DIVERSITY, MAXCONV, forcing, solver="newton")
+    assert np.all(np.isfinite(newton))
+    assert len(np.unique(newton)) > 1
+    np.testing.assert_allclose(newton, converged, atol=0.1)
+    single = [
+        daisyworld_fitness_vectorized(discrete_pop[i], continuous_pop[i], DIVERSITY, MAXCONV, False, forcing, solver="newton")
+        for i in range(NUM_GENOMES)
+    ]
+    np.testing.assert_allclose(single, newton)
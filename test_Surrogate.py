@@ -0,0 +1,26 @@
+"""
+Archive and rank helpers of the ridge surrogate
+"""
+import numpy as np
+
+from Surrogate import RidgeSurrogate, average_ranks, rank_correlation
+
+
+def test_archive_keeps_most_recent_samples():
+    surrogate = RidgeSurrogate(max_archive=5)
+    features = np.arange(16, dtype=float).reshape(8, 2)
+    fitness = np.arange(8, dtype=float)
+    # the first batch alone is larger than the archive
+    surrogate.add(features[:7], fitness[:7])
+    assert surrogate.num_samples == 5
+    np.testing.assert_array_equal(surrogate.fitness, fitness[2:7])
+    surrogate.add(features[7:], fitness[7:])
+    assert surrogate.num_samples == 5
+    np.testing.assert_array_equal(surrogate.fitness, fitness[3:])
+    np.testing.assert_array_equal(surrogate.features, features[3:])
+
+
+def test_ties_share_average_ranks():
+    np.testing.assert_array_equal(average_ranks([2.0, 1.0, 2.0, 3.0]), [1.5, 0.0, 1.5, 3.0])
+    assert rank_correlation([1.0, 2.0, 2.0, 3.0], [1.0, 2.0, 2.0, 3.0]) == 1.0
+    assert np.isnan(rank_correlation([1.0, 1.0, 1.0], [1.0, 2.0, 3.0]))